@@ -25,6 +25,29 @@
 
 #
 # Changelog:
+# 3.18:
+#   * Update the buffer registry once after sorting instead of for every buffer moved.
+# 3.17:
+#   * Save the sort keys of the buffers when unloading, to place buffers without evaluating the rules after a restart.
+#   * Add option autosort.sorting.persist_keys.
+# 3.16:
+#   * Add /autosort profile to show the cost of every rule and helper.
+# 3.15:
+#   * Keep track of the buffer list from signals instead of reading it for every sort.
+#   * Widen the signal delay during bursts of signals and limit the time spent sorting.
+#   * Add options signal_delay_max, max_cpu and autojoin_hold.
+# 3.14:
+#   * Speed up the info hooks by caching parsed orders and results.
+# 3.13:
+#   * Evaluate the remaining weechat eval fragments of a buffer in one call.
+#   * Add option autosort.sorting.batch_eval.
+# 3.12:
+#   * Evaluate common rule fragments in python instead of with weechat eval.
+#   * Only evaluate the helpers used by the rules.
+# 3.11:
+#   * Only move the buffers that are out of place after sorting.
+# 3.10:
+#   * Cache the sort key of every buffer until the buffer changes.
 # 3.9:
 #   * Remove `buffers.pl` from recommended settings.
 # 3,8:
@@ -78,25 +101,49 @@
 #
 
 
+import bisect
+import hashlib
 import json
-import math
+import os
 import re
 import sys
 import time
 import weechat
 
+from collections import OrderedDict
+
 SCRIPT_NAME     = 'autosort'
 SCRIPT_AUTHOR   = 'Maarten de Vries <maarten@de-vri.es>'
-SCRIPT_VERSION  = '3.9'
+SCRIPT_VERSION  = '3.18'
 SCRIPT_LICENSE  = 'GPL3'
 SCRIPT_DESC     = 'Flexible automatic (or manual) buffer sorting based on eval expressions.'
 
 
 config             = None
 hooks              = []
-signal_delay_timer = None
-sort_limit_timer   = None
-sort_queued        = False
+registry           = None
+scheduler          = None
+
+# Eval and info calls counted by /autosort profile, None when not profiling.
+profile_counts     = None
+
+# Sort key of every buffer, dropped when the buffer or the configuration changes.
+key_cache          = {}
+
+# The keys_tag of the configuration the cached and saved sort keys were computed with.
+key_cache_tag      = None
+
+# Properties and local variables of every buffer read by compiled rules, dropped when the buffer changes.
+buffer_properties  = {}
+
+# Sort keys saved by the previous session by buffer full name, and the buffers sorted with one of them.
+saved_keys         = {}
+unconfirmed        = set()
+confirm_timer      = None
+
+# Parsed option lists and results of the autosort_order info.
+order_tables       = None
+order_results      = None
 
 
 # Make sure that unicode, bytes and str are always available in python2 and 3.
@@ -134,11 +181,34 @@ def list_swap(values, a, b):
 def list_move(values, old_index, new_index):
 	values.insert(new_index, values.pop(old_index))
 
-def list_find(collection, value):
+def list_find_identity(collection, value):
 	for i, elem in enumerate(collection):
-		if elem == value: return i
+		if elem is value: return i
 	return None
 
+def longest_increasing_subsequence(values):
+	''' Get the indices of a longest strictly increasing subsequence of a list. '''
+	tails   = []
+	indices = []
+	parents = [None] * len(values)
+	for i, value in enumerate(values):
+		length = bisect.bisect_left(tails, value)
+		if length > 0: parents[i] = indices[length - 1]
+		if length == len(tails):
+			tails.append(value)
+			indices.append(i)
+		else:
+			tails[length]   = value
+			indices[length] = i
+
+	result = []
+	i = indices[-1] if indices else None
+	while i is not None:
+		result.append(i)
+		i = parents[i]
+	result.reverse()
+	return result
+
 class HumanReadableError(Exception):
 	pass
 
@@ -197,8 +267,10 @@ class Config:
 		'script_or_plugin': '${if:${script_name}?${script_name}:${plugin}}',
 	})
 
-	default_signal_delay = 5
-	default_sort_limit   = 100
+	default_signal_delay     = 5
+	default_signal_delay_max = 1000
+	default_sort_limit       = 100
+	default_max_cpu          = 20
 
 	default_signals = 'buffer_opened buffer_merged buffer_unmerged buffer_renamed'
 
@@ -211,20 +283,30 @@ class Config:
 		self.v3_section       = None
 
 		self.case_sensitive   = False
+		self.batch_eval       = True
+		self.persist_keys     = True
 		self.rules            = []
 		self.helpers          = {}
 		self.signals          = []
 		self.signal_delay     = Config.default_signal_delay,
+		self.signal_delay_max = Config.default_signal_delay_max
 		self.sort_limit       = Config.default_sort_limit,
+		self.max_cpu          = Config.default_max_cpu
+		self.autojoin_hold    = 0
 		self.sort_on_config   = True
 		self.debug_log        = False
 
 		self.__case_sensitive = None
+		self.__batch_eval     = None
+		self.__persist_keys   = None
 		self.__rules          = None
 		self.__helpers        = None
 		self.__signals        = None
 		self.__signal_delay   = None
+		self.__signal_delay_max = None
 		self.__sort_limit     = None
+		self.__max_cpu        = None
+		self.__autojoin_hold  = None
 		self.__sort_on_config = None
 		self.__debug_log      = None
 
@@ -248,6 +330,22 @@ class Config:
 			'', '', '', '', '', ''
 		)
 
+		self.__batch_eval = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'batch_eval', 'boolean',
+			'If this option is on, the parts of the sort rules that autosort can not evaluate itself are evaluated with a single call to weechat eval per buffer.',
+			'', 0, 0, 'on', 'on', 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__persist_keys = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'persist_keys', 'boolean',
+			'If this option is on, the sort keys of the buffers are saved in the weechat data directory when autosort is unloaded. Buffers opened with the same name after a restart are placed with their saved key at first, and their rules are evaluated later to confirm it.',
+			'', 0, 0, 'on', 'on', 0,
+			'', '', '', '', '', ''
+		)
+
 		weechat.config_new_option(
 			self.config_file, self.sorting_section,
 			'rules', 'string',
@@ -296,6 +394,14 @@ class Config:
 			'', '', '', '', '', ''
 		)
 
+		self.__signal_delay_max = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'signal_delay_max', 'integer',
+			'Maximum delay in milliseconds to wait after a signal before sorting the buffer list. While signals keep arriving before the previous ones could be sorted, like when joining many channels, the delay doubles with every signal up to this value.',
+			'', 0, 60000, str(Config.default_signal_delay_max), str(Config.default_signal_delay_max), 0,
+			'', '', '', '', '', ''
+		)
+
 		self.__sort_limit = weechat.config_new_option(
 			self.config_file, self.sorting_section,
 			'sort_limit', 'integer',
@@ -304,6 +410,22 @@ class Config:
 			'', '', '', '', '', ''
 		)
 
+		self.__max_cpu = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'max_cpu', 'integer',
+			'Maximum percentage of time spent sorting when signals keep triggering sorts. After a sort that took t milliseconds, signals can trigger a sort again after at least t * (100 - max_cpu) / max_cpu milliseconds, or sort_limit if that is longer.',
+			'', 1, 100, str(Config.default_max_cpu), str(Config.default_max_cpu), 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__autojoin_hold = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'autojoin_hold', 'integer',
+			'If not 0, hold sorting after connecting to an IRC server until no signal was received for this many milliseconds, and then sort once. This avoids sorting many times while autojoining channels.',
+			'', 0, 60000, '0', '0', 0,
+			'', '', '', '', '', ''
+		)
+
 		self.__sort_on_config = weechat.config_new_option(
 			self.config_file, self.sorting_section,
 			'sort_on_config_change', 'boolean',
@@ -332,6 +454,8 @@ class Config:
 		''' Load configuration variables. '''
 
 		self.case_sensitive = weechat.config_boolean(self.__case_sensitive)
+		self.batch_eval     = weechat.config_boolean(self.__batch_eval)
+		self.persist_keys   = weechat.config_boolean(self.__persist_keys)
 
 		rules_blob    = weechat.config_string(self.__rules)
 		helpers_blob  = weechat.config_string(self.__helpers)
@@ -341,7 +465,10 @@ class Config:
 		self.helpers        = decode_helpers(helpers_blob)
 		self.signals        = signals_blob.split()
 		self.signal_delay   = weechat.config_integer(self.__signal_delay)
+		self.signal_delay_max = weechat.config_integer(self.__signal_delay_max)
 		self.sort_limit     = weechat.config_integer(self.__sort_limit)
+		self.max_cpu        = weechat.config_integer(self.__max_cpu)
+		self.autojoin_hold  = weechat.config_integer(self.__autojoin_hold)
 		self.sort_on_config = weechat.config_boolean(self.__sort_on_config)
 		self.debug_log      = weechat.config_boolean(self.__debug_log)
 
@@ -395,42 +522,618 @@ def merge_buffer_list(buffers):
 		result[number].append(buffer)
 	return result.values()
 
-def sort_buffers(hdata, buffers, rules, helpers, case_sensitive):
-	for merged in buffers:
-		for buffer in merged:
-			name = weechat.hdata_string(hdata, buffer, 'name')
+class BufferRegistry:
+	'''
+	The buffers of weechat grouped by number, kept up to date from buffer signals so sorting
+	does not have to walk the buffer list of weechat.
 
-	return sorted(buffers, key=merged_sort_key(rules, helpers, case_sensitive))
+	The updates assume buffers are numbered without gaps, as with weechat.look.buffer_auto_renumber.
+	When a signal leaves the registry in doubt, the buffer list is read again before the next sort.
+	'''
+
+	def __init__(self):
+		self.numbers = {}
+		self.groups  = {}
+		self.valid   = False
+		self.sorting = False
+
+	def rebuild(self):
+		''' Read the buffer list of weechat. '''
+		hdata, buffers = get_buffers()
+		self.numbers = dict((buffer, number) for number, buffer in buffers)
+		self.groups  = dict((merged.number, merged) for merged in merge_buffer_list(buffers))
+		self.valid   = True
+
+	def invalidate(self, reason):
+		if self.valid:
+			debug('Buffer registry out of date ({0}), reading the buffer list before the next sort.'.format(reason))
+		self.valid = False
+
+	def merged(self):
+		''' Get the groups of merged buffers, reading the buffer list first if needed. '''
+		if not self.valid: self.rebuild()
+		return list(self.groups.values())
+
+	def check(self):
+		''' Compare the registry with the buffer list of weechat, and fix it if they differ. '''
+		if not self.valid: return
+		hdata, buffers = get_buffers()
+		actual = dict((buffer, number) for number, buffer in buffers)
+		if actual != self.numbers:
+			wrong = len(set(actual.items()) ^ set(self.numbers.items()))
+			debug('Buffer registry differs from the buffer list in {0} entries, reading it again.'.format(wrong))
+			self.rebuild()
+
+	def shift(self, first, last, offset):
+		''' Renumber the groups numbered from first to last (or the end if None) by offset. '''
+		moved = [merged for number, merged in self.groups.items() if number >= first and (last is None or number <= last)]
+		for merged in moved:
+			del self.groups[merged.number]
+		for merged in moved:
+			merged.number += offset
+			self.groups[merged.number] = merged
+			for buffer in merged: self.numbers[buffer] = merged.number
+
+	def insert(self, buffer):
+		''' Add a buffer in a group of its own, moving the buffers at and after its number. '''
+		number = weechat.buffer_get_integer(buffer, 'number')
+		if number in self.groups: self.shift(number, None, 1)
+		merged = self.groups[number] = MergedBuffers(number)
+		merged.append(buffer)
+		self.numbers[buffer] = number
+
+	def remove(self, buffer):
+		''' Remove a buffer from its group, moving the buffers after it if its group is gone. '''
+		number = self.numbers.pop(buffer, None)
+		if number is None:
+			self.invalidate('unknown buffer {0}'.format(buffer))
+			return
+		merged = self.groups[number]
+		merged.remove(buffer)
+		if merged: return
+
+		del self.groups[number]
+		following = self.groups.get(number + 1)
+		if following is None: return
+		if weechat.buffer_get_integer(following[0], 'number') == number:
+			self.shift(number + 1, None, -1)
+		else:
+			self.invalidate('buffer numbers have gaps')
+
+	def reorder(self, buffers):
+		''' Number the groups in the order they were sorted in. '''
+		self.groups = {}
+		for number, merged in enumerate(buffers, 1):
+			merged.number = number
+			self.groups[number] = merged
+			for buffer in merged: self.numbers[buffer] = number
+
+	def on_signal(self, signal, buffer):
+		if not self.valid: return
+
+		# The buffers moved by a sort are renumbered at once when it is done.
+		if self.sorting:
+			if signal != 'buffer_moved': self.invalidate('{0} while sorting'.format(signal))
+			return
 
-def buffer_sort_key(rules, helpers, case_sensitive):
+		if signal == 'buffer_opened':
+			self.insert(buffer)
+
+		elif signal == 'buffer_closed':
+			self.remove(buffer)
+
+		elif signal == 'buffer_merged':
+			self.remove(buffer)
+			number = weechat.buffer_get_integer(buffer, 'number')
+			if self.valid and number in self.groups:
+				self.groups[number].append(buffer)
+				self.numbers[buffer] = number
+			else:
+				self.invalidate('buffer {0} merged into unknown number {1}'.format(buffer, number))
+
+		elif signal == 'buffer_unmerged':
+			self.remove(buffer)
+			if self.valid: self.insert(buffer)
+
+		elif signal == 'buffer_moved':
+			old = self.numbers.get(buffer)
+			new = weechat.buffer_get_integer(buffer, 'number')
+			if old is None or new > len(self.groups):
+				self.invalidate('buffer {0} moved to {1}'.format(buffer, new))
+			elif old != new:
+				merged = self.groups.pop(old)
+				if old < new: self.shift(old + 1, new, -1)
+				else:         self.shift(new, old - 1, 1)
+				merged.number = new
+				self.groups[new] = merged
+				for buffer in merged: self.numbers[buffer] = new
+
+def sort_buffers(buffers, rules, helpers, case_sensitive, batch_eval):
+	return sorted(buffers, key=merged_sort_key(rules, helpers, case_sensitive, batch_eval))
+
+class EvalContext:
+	''' The state of evaluating compiled rules for one buffer. '''
+
+	def __init__(self, buffer, helpers, case_sensitive):
+		self.buffer         = buffer
+		self.helpers        = helpers
+		self.case_sensitive = case_sensitive
+		self.values         = {}
+		self.results        = {}
+		self.properties     = buffer_properties.setdefault(buffer, {})
+
+	def helper(self, name):
+		''' Get the value of a helper variable, evaluating it on first use. '''
+		value = self.values.get(name)
+		if value is None:
+			value = self.helpers[name].evaluate(self)
+			if not self.case_sensitive: value = casefold(value)
+			self.values[name] = value
+		return value
+
+	def property(self, name):
+		''' Get a string property of the buffer, as for weechat.buffer_get_string. '''
+		value = self.properties.get(name)
+		if value is None:
+			value = self.properties[name] = weechat.buffer_get_string(self.buffer, name)
+		return value
+
+	def batch_eval(self, fragments):
+		'''
+		Evaluate weechat eval fragments with a single call to weechat eval.
+		Every result is escaped with autosort_escape and the results are separated by commas.
+		If the results can not be split back, the fragments are left to be evaluated separately.
+		'''
+		if len(fragments) < 2: return
+		names      = sorted(set(name for fragment in fragments for name in fragment.helpers))
+		extra_vars = dict((name, self.helper(name)) for name in names)
+		expression = ','.join(['${info:autosort_escape,' + fragment.expression + '}' for fragment in fragments])
+		expanded   = weechat.string_eval_expression(expression, {"buffer": self.buffer}, extra_vars, {})
+		if profile_counts: profile_counts.evals += 1
+		results, rest = parse_args(expanded)
+		if len(results) != len(fragments):
+			debug('Batched evaluation gave {0} results instead of {1}, evaluating the fragments separately.'.format(len(results), len(fragments)))
+			return
+		self.results.update(zip(fragments, results))
+
+class Literal:
+	def __init__(self, text):
+		self.text = text
+
+	def evaluate(self, context):
+		return self.text
+
+class Concat:
+	def __init__(self, parts):
+		self.parts = parts
+
+	def evaluate(self, context):
+		return ''.join([part.evaluate(context) for part in self.parts])
+
+class BufferProperty:
+	''' A buffer property or local variable, by its weechat.buffer_get_string name. '''
+	def __init__(self, name):
+		self.name = name
+
+	def evaluate(self, context):
+		return context.property(self.name)
+
+class HelperVariable:
+	def __init__(self, name):
+		self.name = name
+
+	def evaluate(self, context):
+		return context.helper(self.name)
+
+class Info:
+	''' An info, with a python function for the autosort info hooks. '''
+	def __init__(self, name, arguments, function):
+		self.name      = name
+		self.arguments = arguments
+		self.function  = function
+
+	def evaluate(self, context):
+		arguments = self.arguments.evaluate(context)
+		if self.function is not None:
+			return self.function('', self.name, arguments)
+		if profile_counts: profile_counts.infos += 1
+		return weechat.info_get(self.name, arguments)
+
+class Condition:
+	''' A condition without operator, or with a single == or != comparison. '''
+	def __init__(self, operator, left, right):
+		self.operator = operator
+		self.left     = left
+		self.right    = right
+
+	def evaluate(self, context):
+		left = self.left.evaluate(context)
+		if self.operator is None:
+			return left != '' and left != '0'
+		right = self.right.evaluate(context)
+
+		# Like weechat, compare numbers as numbers.
+		left_number  = eval_number(left)
+		right_number = eval_number(right)
+		if left_number is not None and right_number is not None:
+			equal = left_number == right_number
+		else:
+			equal = left == right
+		return equal == (self.operator == '==')
+
+class IfElse:
+	def __init__(self, condition, if_true, if_false):
+		self.condition = condition
+		self.if_true   = if_true
+		self.if_false  = if_false
+
+	def evaluate(self, context):
+		result = self.condition.evaluate(context)
+		if self.if_true is None:
+			return '1' if result else '0'
+		return self.if_true.evaluate(context) if result else self.if_false.evaluate(context)
+
+class WeechatEval:
+	''' A fragment evaluated by weechat, with the helper variables it uses. '''
+	def __init__(self, expression, helpers):
+		self.expression = expression
+		self.helpers    = helpers
+
+	def batchable(self):
+		''' Check if the fragment is a single ${...} expression that can be nested in a batch. '''
+		expression = self.expression
+		return '\\' not in expression and expression.startswith('${') and find_closing(expression, 2) == len(expression) - 1
+
+	def evaluate(self, context):
+		result = context.results.get(self)
+		if result is not None: return result
+		extra_vars = dict((name, context.helper(name)) for name in self.helpers)
+		if profile_counts: profile_counts.evals += 1
+		return weechat.string_eval_expression(self.expression, {"buffer": context.buffer}, extra_vars, {})
+
+number_regex    = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+local_var_regex = re.compile(r'^\w+$')
+variable_regex  = re.compile(r'\$\{([^${}]*)\}')
+
+# Names without dots or prefix that weechat eval does not resolve to a local variable or an empty string:
+# date comes before the local variables, buffer and window are hdata with a pointer, used when there is
+# no local variable of that name. Options always have dots.
+weechat_builtin_variables = ('date', 'buffer', 'window')
+
+# Buffer properties that only change along with a signal that drops the cached properties.
+native_buffer_properties = ('full_name', 'name', 'short_name')
+
+# Comparison operators of weechat conditions other than == and !=, and grouping.
+unsupported_operators = ('||', '&&', '=~', '!~', '=*', '!*', '=-', '!-', '<', '>', '(')
+
+def eval_number(text):
+	''' Parse a number the way weechat eval compares them, or return None. '''
+	if text == '': return 0.0
+	if not number_regex.match(text): return None
+	return float(text)
+
+def find_closing(text, start):
+	''' Find the } closing a ${ that ends right before start, or -1. '''
+	depth = 1
+	i = start
+	while i < len(text):
+		if text.startswith('${', i):
+			depth += 1
+			i += 2
+			continue
+		if text[i] == '}':
+			depth -= 1
+			if depth == 0: return i
+		i += 1
+	return -1
+
+def find_top_level(text, needle):
+	''' Find needle in text outside of any ${...}, or -1. '''
+	i = 0
+	while i < len(text):
+		if text.startswith('${', i):
+			end = find_closing(text, i + 2)
+			if end < 0: return -1
+			i = end + 1
+			continue
+		if text.startswith(needle, i): return i
+		i += 1
+	return -1
+
+def compile_template(text, helpers):
+	'''
+	Compile an eval expression into a tree of objects with an evaluate(context) method.
+	The helpers are the names of the helper variables the expression can use.
+	Fragments that can not be compiled are left to weechat eval.
+	'''
+	# Escaped characters are left to weechat.
+	if '\\' in text:
+		return weechat_eval(text, helpers)
+
+	parts = []
+	i = 0
+	while i < len(text):
+		start = text.find('${', i)
+		if start < 0:
+			parts.append(Literal(text[i:]))
+			break
+		if start > i: parts.append(Literal(text[i:start]))
+		end = find_closing(text, start + 2)
+		if end < 0:
+			parts.append(weechat_eval(text[start:], helpers))
+			break
+		parts.append(compile_variable(text[start:end + 1], text[start + 2:end], helpers))
+		i = end + 1
+
+	if not parts: return Literal('')
+	if len(parts) == 1: return parts[0]
+	return Concat(parts)
+
+def compile_variable(expression, name, helpers):
+	''' Compile a single ${name} expression. '''
+	# Helpers come first, like extra variables in weechat eval.
+	if name in helpers:
+		return HelperVariable(name)
+
+	if name.startswith('if:'):
+		return compile_if(expression, name[3:], helpers)
+
+	if name.startswith('info:'):
+		info, comma, arguments = name[5:].partition(',')
+		if '${' not in info:
+			return Info(info, compile_template(arguments, helpers), native_infos().get(info))
+
+	if name.startswith('buffer.'):
+		variable = name[7:]
+		if variable in native_buffer_properties:
+			return BufferProperty(variable)
+		if variable.startswith('local_variables.') and local_var_regex.match(variable[16:]):
+			return BufferProperty('localvar_' + variable[16:])
+
+	# Other names without dots or prefix are local variables, or empty if the buffer does not have them.
+	if local_var_regex.match(name) and name not in weechat_builtin_variables:
+		return BufferProperty('localvar_' + name)
+
+	return weechat_eval(expression, helpers)
+
+def compile_if(expression, content, helpers):
+	''' Compile the content of an ${if:condition?if_true:if_false} expression. '''
+	question  = find_top_level(content, '?')
+	condition = compile_condition(content if question < 0 else content[:question], helpers)
+	if condition is None:
+		return weechat_eval(expression, helpers)
+	if question < 0:
+		return IfElse(condition, None, None)
+
+	branches = content[question + 1:]
+	colon    = find_top_level(branches, ':')
+	if colon < 0:
+		return IfElse(condition, compile_template(branches, helpers), Literal(''))
+	return IfElse(condition, compile_template(branches[:colon], helpers), compile_template(branches[colon + 1:], helpers))
+
+def compile_condition(text, helpers):
+	''' Compile a condition, or return None if it uses unsupported operators. '''
+	for operator in unsupported_operators:
+		if find_top_level(text, operator) >= 0: return None
+
+	for operator in ('==', '!='):
+		position = find_top_level(text, operator)
+		if position >= 0:
+			left  = compile_template(text[:position].strip(' '), helpers)
+			right = compile_template(text[position + len(operator):].strip(' '), helpers)
+			return Condition(operator, left, right)
+
+	return Condition(None, compile_template(text.strip(' '), helpers), None)
+
+def weechat_eval(expression, helpers):
+	''' Leave an expression to weechat eval, with the helpers it refers to. '''
+	used = sorted(set(name for name in variable_regex.findall(expression) if name in helpers))
+	return WeechatEval(expression, used)
+
+def native_infos():
+	''' The info hooks of autosort, called directly by compiled rules. '''
+	return {
+		'autosort_escape':  on_info_escape,
+		'autosort_replace': on_info_replace,
+		'autosort_order':   on_info_order,
+	}
+
+def compiled_nodes(node):
+	''' Yield a compiled expression and all expressions below it. '''
+	yield node
+	children = []
+	if isinstance(node, Concat):
+		children = node.parts
+	elif isinstance(node, Info):
+		children = [node.arguments]
+	elif isinstance(node, Condition):
+		children = [node.left, node.right]
+	elif isinstance(node, IfElse):
+		children = [node.condition, node.if_true, node.if_false]
+	for child in children:
+		if child is not None:
+			for descendant in compiled_nodes(child): yield descendant
+
+def used_helpers(compiled_rules):
+	''' Get the names of the helpers used by the compiled rules. '''
+	used = set()
+	for rule in compiled_rules:
+		for node in compiled_nodes(rule):
+			if isinstance(node, HelperVariable): used.add(node.name)
+			elif isinstance(node, WeechatEval):  used.update(node.helpers)
+	return used
+
+def batch_fragments(compiled_rules, compiled_helpers):
+	'''
+	Find the weechat eval fragments that can be evaluated in a batch.
+	Returns the fragments of the helpers used by the rules and the fragments of the rules,
+	as helper values have to be known before the rules are evaluated.
+	'''
+	rule_nodes   = [node for rule in compiled_rules for node in compiled_nodes(rule)]
+	used         = used_helpers(compiled_rules)
+	helper_nodes = [node for name in sorted(used) for node in compiled_nodes(compiled_helpers[name])]
+	batchable = lambda nodes: [node for node in nodes if isinstance(node, WeechatEval) and node.batchable()]
+	return batchable(helper_nodes), batchable(rule_nodes)
+
+def compile_rules(rules, helpers):
+	''' Compile the rules and the helpers. '''
+	compiled_helpers = dict((name, compile_template(helper, ())) for name, helper in helpers.items())
+	compiled_rules   = [compile_template(rule, helpers) for rule in rules]
+	return compiled_rules, compiled_helpers
+
+def buffer_sort_key(rules, helpers, case_sensitive, batch_eval = False):
 	''' Create a sort key function for a list of lists of merged buffers. '''
+	compiled_rules, compiled_helpers = compile_rules(rules, helpers)
+	helper_fragments, rule_fragments = batch_fragments(compiled_rules, compiled_helpers) if batch_eval else ([], [])
 	def key(buffer):
-		extra_vars = {}
-		for helper_name, helper in sorted(helpers.items()):
-			expanded = weechat.string_eval_expression(helper, {"buffer": buffer}, {}, {})
-			extra_vars[helper_name] = expanded if case_sensitive else casefold(expanded)
+		context = EvalContext(buffer, compiled_helpers, case_sensitive)
+		context.batch_eval(helper_fragments)
+		context.batch_eval(rule_fragments)
 		result = []
-		for rule in rules:
-			expanded = weechat.string_eval_expression(rule, {"buffer": buffer}, extra_vars, {})
+		for rule in compiled_rules:
+			expanded = rule.evaluate(context)
 			result.append(expanded if case_sensitive else casefold(expanded))
 		return result
 
 	return key
 
-def merged_sort_key(rules, helpers, case_sensitive):
-	buffer_key = buffer_sort_key(rules, helpers, case_sensitive)
+def merged_sort_key(rules, helpers, case_sensitive, batch_eval = False):
+	buffer_key = buffer_sort_key(rules, helpers, case_sensitive, batch_eval)
 	def key(merged):
 		best = None
 		for buffer in merged:
-			this = buffer_key(buffer)
+			this = key_cache.get(buffer)
+			if this is None:
+				this = saved_key(buffer)
+			if this is None:
+				this = key_cache[buffer] = buffer_key(buffer)
 			if best is None or this < best: best = this
 		return best
 	return key
 
+def keys_path():
+	''' The file holding the sort keys saved by persist_keys. '''
+	data_dir = weechat.info_get('weechat_data_dir', '') or weechat.info_get('weechat_dir', '')
+	return os.path.join(data_dir, 'autosort_keys.json')
+
+def keys_tag():
+	''' A hash of the configuration the sort keys depend on. '''
+	blob = json.dumps([config.rules, config.helpers, config.case_sensitive], sort_keys=True)
+	return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+def load_keys():
+	''' Load the sort keys saved by the previous session, if they were computed with the same rules. '''
+	global saved_keys, key_cache_tag
+	saved_keys    = {}
+	key_cache_tag = keys_tag()
+	if not config.persist_keys: return
+	try:
+		with open(keys_path()) as keys_file:
+			saved = json.load(keys_file)
+	except (IOError, OSError, ValueError):
+		return
+	if not isinstance(saved, dict) or saved.get('tag') != keys_tag():
+		debug('Saved sort keys were computed with other rules, ignoring them.')
+		return
+	for name, key in saved.get('keys', {}).items():
+		saved_keys[ensure_str(name)] = [ensure_str(x) for x in key]
+	debug('Loaded {0} saved sort keys.'.format(len(saved_keys)))
+
+def save_keys():
+	''' Save the sort keys of the open buffers by full name. '''
+	if not config.persist_keys: return
+	keys = {}
+	for buffer, key in key_cache.items():
+		if buffer in registry.numbers:
+			keys[weechat.buffer_get_string(buffer, 'full_name')] = key
+	path = keys_path()
+	try:
+		with open(path + '.tmp', 'w') as keys_file:
+			json.dump({'tag': keys_tag(), 'keys': keys}, keys_file)
+		os.rename(path + '.tmp', path)
+	except (IOError, OSError) as e:
+		log('Failed to save sort keys to {0}: {1}'.format(path, e))
+
+def saved_key(buffer):
+	'''
+	Get the saved sort key of a buffer that has no key yet, to sort it without evaluating the rules.
+	The rules are evaluated later by on_confirm_timeout.
+	'''
+	global confirm_timer
+	if not saved_keys: return None
+	key = saved_keys.pop(weechat.buffer_get_string(buffer, 'full_name'), None)
+	if key is None: return None
+
+	key_cache[buffer] = key
+	unconfirmed.add(buffer)
+	if confirm_timer is None:
+		confirm_timer = weechat.hook_timer(confirm_interval, 0, 1, 'on_confirm_timeout', '')
+	return key
+
+def on_confirm_timeout(pointer, remaining_calls):
+	''' Evaluate the rules for some of the buffers sorted with a saved key, and sort again if a key changed. '''
+	global confirm_timer
+	confirm_timer = None
+
+	key     = buffer_sort_key(config.rules, config.helpers, config.case_sensitive, config.batch_eval)
+	changed = 0
+	for i in range(min(confirm_batch, len(unconfirmed))):
+		buffer = unconfirmed.pop()
+		if buffer not in registry.numbers: continue
+		this = key(buffer)
+		if key_cache.get(buffer) != this:
+			key_cache[buffer] = this
+			changed += 1
+
+	if changed:
+		debug('{0} saved sort keys changed, sorting again.'.format(changed))
+		scheduler.signal('autosort_keys_changed')
+	if unconfirmed:
+		confirm_timer = weechat.hook_timer(confirm_interval, 0, 1, 'on_confirm_timeout', '')
+	return weechat.WEECHAT_RC_OK
+
+def forget_saved_keys():
+	''' Forget the saved sort keys, when the rules change. '''
+	global confirm_timer
+	saved_keys.clear()
+	unconfirmed.clear()
+	if confirm_timer is not None:
+		weechat.unhook(confirm_timer)
+		confirm_timer = None
+
+# Number of buffers sorted with a saved key to evaluate the rules for at once, and the delay in milliseconds in between.
+confirm_batch    = 50
+confirm_interval = 100
+
 def apply_buffer_order(buffers):
-	''' Sort the buffers in weechat according to the given order. '''
-	for i, buffer in enumerate(buffers):
-		weechat.buffer_set(buffer[0], "number", str(i + 1))
+	'''
+	Sort the buffers in weechat according to the given order.
+	Only the buffers that are out of place are moved. Returns the number of moves.
+	'''
+	current = sorted(buffers, key=lambda merged: merged.number)
+
+	# Moving a buffer to a number only shifts the others if there are no gaps in the numbering.
+	if [merged.number for merged in current] != list(range(1, len(current) + 1)):
+		for i, buffer in enumerate(buffers):
+			weechat.buffer_set(buffer[0], "number", str(i + 1))
+		return len(buffers)
+
+	# The longest run of buffers already in the right relative order stays in place.
+	# Every other buffer is moved right after the buffer preceding it in the new order,
+	# in the new order, so every buffer before it is already in place.
+	target   = dict((id(merged), i) for i, merged in enumerate(buffers))
+	position = [target[id(merged)] for merged in current]
+	keep     = set(position[i] for i in longest_increasing_subsequence(position))
+
+	moves = 0
+	for i, merged in enumerate(buffers):
+		if i in keep: continue
+		current.pop(list_find_identity(current, merged))
+		index = list_find_identity(current, buffers[i - 1]) + 1 if i > 0 else 0
+		current.insert(index, merged)
+		weechat.buffer_set(merged[0], "number", str(index + 1))
+		moves += 1
+	return moves
 
 def split_args(args, expected, optional = 0):
 	''' Split an argument string in the desired number of arguments. '''
@@ -440,21 +1143,41 @@ def split_args(args, expected, optional = 0):
 	return split[:-1] + pad(split[-1].split(' ', optional), optional + 1, '')
 
 def do_sort(verbose = False):
+	''' Sort the buffers and return the time it took in seconds. '''
 	start = perf_counter()
 
-	hdata, buffers = get_buffers()
-	buffers = merge_buffer_list(buffers)
-	buffers = sort_buffers(hdata, buffers, config.rules, config.helpers, config.case_sensitive)
-	apply_buffer_order(buffers)
+	buffers = registry.merged()
+
+	# Forget the keys of buffers that went away without a signal.
+	live = registry.numbers
+	if len(key_cache) > len(live) or len(buffer_properties) > len(live):
+		for pointer in list(key_cache):
+			if pointer not in live: del key_cache[pointer]
+		for pointer in list(buffer_properties):
+			if pointer not in live: del buffer_properties[pointer]
+
+	cached = len(key_cache)
+	buffers = sort_buffers(buffers, config.rules, config.helpers, config.case_sensitive, config.batch_eval)
+	registry.sorting = True
+	try:
+		moves = apply_buffer_order(buffers)
+	finally:
+		registry.sorting = False
+	if registry.valid: registry.reorder(buffers)
+	computed = len(key_cache) - cached
 
 	elapsed = perf_counter() - start
 	if verbose:
 		log("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
 	else:
-		debug("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		debug("Finished sorting buffers in {0:.4f} seconds, computed {1} of {2} sort keys, moved {3} of {4} buffers.".format(elapsed, computed, len(key_cache), moves, len(buffers)))
+	return elapsed
 
 def command_sort(buffer, command, args):
-	''' Sort the buffers and print a confirmation. '''
+	''' Compute the sort key of every buffer again, sort the buffers and print a confirmation. '''
+	key_cache.clear()
+	buffer_properties.clear()
+	forget_saved_keys()
 	do_sort(True)
 	return weechat.WEECHAT_RC_OK
 
@@ -465,7 +1188,7 @@ def command_debug(buffer, command, args):
 	# Show evaluation results.
 	log('Individual evaluation results:')
 	start = perf_counter()
-	key = buffer_sort_key(config.rules, config.helpers, config.case_sensitive)
+	key = buffer_sort_key(config.rules, config.helpers, config.case_sensitive, config.batch_eval)
 	results = []
 	for merged in buffers:
 		for buffer in merged:
@@ -481,6 +1204,85 @@ def command_debug(buffer, command, args):
 
 	return weechat.WEECHAT_RC_OK
 
+class ProfileCounts:
+	''' The cost of a rule or helper, or of all rules and helpers for a buffer. '''
+
+	def __init__(self, name):
+		self.name    = name
+		self.elapsed = 0.0
+		self.evals   = 0
+		self.infos   = 0
+		self.worst   = 0.0
+		self.buffers = 0
+
+	def add(self, other, elapsed):
+		''' Add the cost of one evaluation, with the eval and info calls counted in other. '''
+		self.elapsed += elapsed
+		self.evals   += other.evals
+		self.infos   += other.infos
+		self.worst    = max(self.worst, elapsed)
+		self.buffers += 1
+
+def command_profile(buffer, command, args):
+	''' Time every rule and helper separately for every buffer and show the most expensive ones. '''
+	global profile_counts
+
+	compiled_rules, compiled_helpers = compile_rules(config.rules, config.helpers)
+	used = used_helpers(compiled_rules)
+	case_sensitive = config.case_sensitive
+
+	items = {}
+	for name in compiled_helpers:
+		items[('helper', name)] = ProfileCounts('helper {0}: {1}'.format(name, config.helpers[name]))
+	for i, rule in enumerate(config.rules):
+		items[('rule', i)] = ProfileCounts('rule {0}: {1}'.format(i, rule))
+
+	buffers = [buffer for merged in registry.merged() for buffer in merged]
+	per_buffer = []
+	start = perf_counter()
+	try:
+		for pointer in buffers:
+			# Start without cached properties, to measure what a new buffer costs.
+			context = EvalContext(pointer, compiled_helpers, case_sensitive)
+			context.properties = {}
+			total = ProfileCounts(weechat.buffer_get_string(pointer, 'full_name'))
+
+			# Helpers first, so the cost of a helper is not counted in the rules using it.
+			evaluations  = [(('helper', name), lambda name = name: context.helper(name)) for name in sorted(compiled_helpers)]
+			evaluations += [(('rule', i), lambda rule = rule: rule.evaluate(context) if case_sensitive else casefold(rule.evaluate(context))) for i, rule in enumerate(compiled_rules)]
+			for key, evaluate in evaluations:
+				profile_counts = ProfileCounts(None)
+				began = perf_counter()
+				evaluate()
+				elapsed = perf_counter() - began
+				items[key].add(profile_counts, elapsed)
+				total.add(profile_counts, elapsed)
+			per_buffer.append(total)
+	finally:
+		profile_counts = None
+	elapsed = perf_counter() - start
+
+	log('Profile of {0} rules and {1} helpers over {2} buffers, took {3:.4f} seconds:'.format(len(config.rules), len(config.helpers), len(buffers), elapsed))
+	output  = 'Rules and helpers, most expensive first:\n'
+	output += '    {0:>10} {1:>10} {2:>10} {3:>7} {4:>7}  {5}\n'.format('total ms', 'avg us', 'max us', 'evals', 'infos', 'rule or helper')
+	for key, item in sorted(items.items(), key=lambda entry: -entry[1].elapsed):
+		note = ''
+		if key[0] == 'helper' and key[1] not in used:
+			note = ' (unused, skipped when sorting)'
+		output += '    {0:10.3f} {1:10.1f} {2:10.1f} {3:7} {4:7}  {5}{6}\n'.format(
+			item.elapsed * 1e3, item.elapsed * 1e6 / max(item.buffers, 1), item.worst * 1e6,
+			item.evals, item.infos, ensure_str(item.name), note)
+
+	output += 'Most expensive buffers:\n'
+	output += '    {0:>10} {1:>7} {2:>7}  {3}\n'.format('total ms', 'evals', 'infos', 'buffer')
+	for item in sorted(per_buffer, key=lambda item: -item.elapsed)[:profile_buffers]:
+		output += '    {0:10.3f} {1:7} {2:7}  {3}\n'.format(item.elapsed * 1e3, item.evals, item.infos, ensure_str(item.name))
+	log(output)
+	return weechat.WEECHAT_RC_OK
+
+# Number of buffers shown by /autosort profile.
+profile_buffers = 10
+
 def command_rule_list(buffer, command, args):
 	''' Show the list of sorting rules. '''
 	output = 'Sorting rules:\n'
@@ -639,75 +1441,132 @@ def call_command(buffer, command, args, subcommands):
 	log('{0}: command not found'.format(' '.join(command)))
 	return weechat.WEECHAT_RC_ERROR
 
-def on_signal(data, signal, signal_data):
-	global signal_delay_timer
-	global sort_queued
+class SortScheduler:
+	'''
+	Decides when signals trigger a sort.
+
+	A sort waits for signal_delay after the last signal. While signals keep arriving before
+	the previous ones could be sorted, the delay doubles with every signal up to
+	signal_delay_max, so a burst of signals is sorted once or a few times. A pending sort
+	never waits more than signal_delay_max after the first signal it is waiting for. After a
+	sort, the next one waits long enough to keep the time spent sorting under max_cpu
+	percent, and at least sort_limit. After connecting to an IRC server with autojoin_hold
+	set, sorting waits until signals have been quiet for autojoin_hold, up to
+	autojoin_hold_limit seconds.
+	'''
 
-	# If the sort limit timeout is started, we're in the hold-off time after sorting, just queue a sort.
-	if sort_limit_timer is not None:
-		if sort_queued:
-			debug('Signal {0} ignored, sort limit timeout is active and sort is already queued.'.format(signal))
+	def __init__(self):
+		self.timer         = None
+		self.timer_due     = None
+		self.pending       = False
+		self.delay         = 0.0
+		self.last_signal   = None
+		self.first_pending = None
+		self.signal_rate   = 0.0
+		self.last_sort     = None
+		self.holdoff       = 0.0
+		self.hold_since    = None
+
+	def due(self):
+		''' The time at which the pending sort can run. '''
+		# However long the delay grew, do not let a steady stream of signals hold the sort forever.
+		max_delay = max(config.signal_delay, config.signal_delay_max) / 1000.0
+		due = min(self.last_signal + self.delay, self.first_pending + max_delay)
+		if self.last_sort is not None:
+			due = max(due, self.last_sort + self.holdoff)
+		if self.hold_since is not None:
+			quiet = min(self.last_signal + config.autojoin_hold / 1000.0, self.hold_since + autojoin_hold_limit)
+			due = max(due, quiet)
+		return due
+
+	def signal(self, signal):
+		''' Called for every signal that should trigger a sort. '''
+		now  = perf_counter()
+		base = config.signal_delay / 1000.0
+		if self.last_signal is not None:
+			interval = max(now - self.last_signal, 1e-6)
+			self.signal_rate = 0.8 * self.signal_rate + 0.2 / interval
+
+		# Signals arriving before the previous one could be sorted are a burst: wait longer before sorting.
+		busy = self.pending or (self.last_sort is not None and now < self.last_sort + self.holdoff)
+		if busy:
+			self.delay = min(max(self.delay, 0.001) * 2, max(base, config.signal_delay_max / 1000.0))
 		else:
-			debug('Signal {0} received but sort limit timeout is active, sort is now queued.'.format(signal))
-		sort_queued = True
-		return weechat.WEECHAT_RC_OK
-
-	# If the signal delay timeout is started, a signal was recently received, so ignore this signal.
-	if signal_delay_timer is not None:
-		debug('Signal {0} ignored, signal delay timeout active.'.format(signal))
-		return weechat.WEECHAT_RC_OK
-
-	# Otherwise, start the signal delay timeout.
-	debug('Signal {0} received, starting signal delay timeout of {1} ms.'.format(signal, config.signal_delay))
-	weechat.hook_timer(config.signal_delay, 0, 1, "on_signal_delay_timeout", "")
-	return weechat.WEECHAT_RC_OK
+			self.delay = base
+
+		if not self.pending:
+			self.first_pending = now
+		self.last_signal = now
+		self.pending     = True
+		due = self.due()
+		debug('Signal {0} received ({1:.1f}/s), sorting in {2:.0f} ms.'.format(signal, self.signal_rate, (due - now) * 1000))
+		self.schedule(due, now)
+
+	def hold(self, signal):
+		''' Called when connecting to an IRC server, to hold sorting until autojoin is done. '''
+		if self.hold_since is None:
+			debug('Holding sorts until signals are quiet for {0} ms.'.format(config.autojoin_hold))
+			self.hold_since = perf_counter()
+		self.signal(signal)
+
+	def schedule(self, due, now):
+		''' Make sure the timer fires by the due time. '''
+		if self.timer is not None:
+			if self.timer_due <= due: return
+			weechat.unhook(self.timer)
+		self.timer_due = due
+		self.timer     = weechat.hook_timer(int((due - now) * 1000) + 1, 0, 1, 'on_sort_timeout', '')
+
+	def timeout(self):
+		''' Called when the timer fires, to sort or wait some more. '''
+		self.timer = None
+		if not self.pending: return
+
+		now = perf_counter()
+		due = self.due()
+		if due - now > 0.001:
+			self.schedule(due, now)
+			return
 
-def on_signal_delay_timeout(pointer, remaining_calls):
-	""" Called when the signal_delay_timer triggers. """
-	global signal_delay_timer
-	global sort_limit_timer
-	global sort_queued
+		if self.hold_since is not None:
+			debug('Signals quiet after {0:.1f} seconds, no longer holding sorts.'.format(now - self.hold_since))
+			self.hold_since = None
 
-	signal_delay_timer = None
+		self.pending   = False
+		elapsed        = do_sort()
+		self.last_sort = perf_counter()
+		self.delay     = config.signal_delay / 1000.0
 
-	# If the sort limit timeout was started, we're still in the no-sort period, so just queue a sort.
-	if sort_limit_timer is not None:
-		debug('Signal delay timeout expired, but sort limit timeout is active, sort is now queued.')
-		sort_queued = True
-		return weechat.WEECHAT_RC_OK
+		# Keep the time spent sorting under max_cpu percent.
+		share = max(config.max_cpu, 1) / 100.0
+		self.holdoff = max(config.sort_limit / 1000.0, elapsed * (1 - share) / share)
 
-	# Time to sort!
-	debug('Signal delay timeout expired, starting sort.')
-	do_sort()
+# Maximum number of seconds autojoin_hold holds sorting after connecting to a server.
+autojoin_hold_limit     = 30
 
-	# Start the sort limit timeout if not disabled.
-	if config.sort_limit > 0:
-		debug('Starting sort limit timeout of {0} ms.'.format(config.sort_limit))
-		sort_limit_timer = weechat.hook_timer(config.sort_limit, 0, 1, "on_sort_limit_timeout", "")
+# Seconds between checks of the buffer registry against the buffer list, in debug mode.
+registry_check_interval = 60
 
+def on_signal(data, signal, signal_data):
+	scheduler.signal(signal)
 	return weechat.WEECHAT_RC_OK
 
-def on_sort_limit_timeout(pointer, remainin_calls):
-	""" Called when de sort_limit_timer triggers. """
-	global sort_limit_timer
-	global sort_queued
-
-	# If no signal was received during the timeout, we're done.
-	if not sort_queued:
-		debug('Sort limit timeout expired without receiving a signal.')
-		sort_limit_timer = None
-		return weechat.WEECHAT_RC_OK
+def on_irc_connected(data, signal, signal_data):
+	scheduler.hold(signal)
+	return weechat.WEECHAT_RC_OK
 
-	# Otherwise it's time to sort.
-	debug('Signal received during sort limit timeout, starting queued sort.')
-	do_sort()
-	sort_queued = False
+def on_sort_timeout(pointer, remaining_calls):
+	scheduler.timeout()
+	return weechat.WEECHAT_RC_OK
 
-	# Start the sort limit timeout again if not disabled.
-	if config.sort_limit > 0:
-		debug('Starting sort limit timeout of {0} ms.'.format(config.sort_limit))
-		sort_limit_timer = weechat.hook_timer(config.sort_limit, 0, 1, "on_sort_limit_timeout", "")
+def on_buffer_list_changed(data, signal, buffer):
+	''' Called when a buffer is opened, closed, merged, unmerged or moved, to update the registry. '''
+	registry.on_signal(signal, buffer)
+	return weechat.WEECHAT_RC_OK
 
+def on_registry_check_timeout(pointer, remaining_calls):
+	''' Called periodically to check the buffer registry in debug mode. '''
+	if config.debug_log: registry.check()
 	return weechat.WEECHAT_RC_OK
 
 
@@ -715,8 +1574,11 @@ def apply_config():
 	# Unhook all signals and hook the new ones.
 	for hook in hooks:
 		weechat.unhook(hook)
+	del hooks[:]
 	for signal in config.signals:
 		hooks.append(weechat.hook_signal(signal, 'on_signal', ''))
+	if config.autojoin_hold > 0:
+		hooks.append(weechat.hook_signal('irc_server_connected', 'on_irc_connected', ''))
 
 	if config.sort_on_config:
 		debug('Sorting because configuration changed.')
@@ -724,50 +1586,97 @@ def apply_config():
 
 def on_config_changed(*args, **kwargs):
 	''' Called whenever the configuration changes. '''
+	global key_cache_tag
 	config.reload()
+	# Only the options the sort keys depend on invalidate them.
+	tag = keys_tag()
+	if tag != key_cache_tag:
+		key_cache_tag = tag
+		key_cache.clear()
+		forget_saved_keys()
 	apply_config()
 
 	return weechat.WEECHAT_RC_OK
 
+def on_buffer_changed(data, signal, buffer):
+	''' Called when a buffer is opened or changed, to forget its sort key and properties. '''
+	buffer_properties.pop(buffer, None)
+	# A buffer sorted with a saved key keeps it while its local variables are set, until it is confirmed.
+	if buffer in unconfirmed and signal.startswith('buffer_localvar_'):
+		return weechat.WEECHAT_RC_OK
+	key_cache.pop(buffer, None)
+	unconfirmed.discard(buffer)
+	return weechat.WEECHAT_RC_OK
+
+def on_unload():
+	''' Called when the script is unloaded, to save the sort keys. '''
+	save_keys()
+	return weechat.WEECHAT_RC_OK
+
+class LRUCache:
+	''' A dictionary that forgets the least recently used entries past a maximum size. '''
+
+	def __init__(self, size):
+		self.size    = size
+		self.entries = OrderedDict()
+
+	def get(self, key):
+		value = self.entries.pop(key, None)
+		if value is not None: self.entries[key] = value
+		return value
+
+	def set(self, key, value):
+		self.entries.pop(key, None)
+		self.entries[key] = value
+		if len(self.entries) > self.size: self.entries.popitem(last = False)
+
 def parse_arg(args):
+	''' Split the first argument off an argument string, removing escaping backslashes. '''
 	if not args: return '', None
 
-	result  = ''
-	escaped = False
-	for i, c in enumerate(args):
-		if not escaped:
-			if c == '\\':
-				escaped = True
-				continue
-			elif c == ',':
-				return result, args[i+1:]
-		result  += c
-		escaped  = False
-	return result, None
+	comma     = args.find(',')
+	backslash = args.find('\\')
+	if backslash < 0 or 0 <= comma < backslash:
+		if comma < 0: return args, None
+		return args[:comma], args[comma + 1:]
+
+	result = []
+	start  = 0
+	while True:
+		comma     = args.find(',', start)
+		backslash = args.find('\\', start)
+		if backslash < 0 or 0 <= comma < backslash:
+			if comma < 0:
+				result.append(args[start:])
+				return ''.join(result), None
+			result.append(args[start:comma])
+			return ''.join(result), args[comma + 1:]
+		# Keep the escaped character, whatever it is.
+		result.append(args[start:backslash])
+		result.append(args[backslash + 1:backslash + 2])
+		start = backslash + 2
 
 def parse_args(args, max = None):
 	result = []
-	i = 0
-	while max is None or i < max:
-		i += 1
+	while args is not None and (max is None or len(result) < max):
+		if '\\' not in args:
+			# Without escapes, the remaining arguments are simply separated by commas.
+			remaining = None if max is None else max - len(result)
+			split     = args.split(',') if remaining is None else args.split(',', remaining)
+			if remaining is not None and len(split) > remaining:
+				return result + split[:remaining], split[remaining]
+			return result + split, None
 		arg, args = parse_arg(args)
-		if arg is None: break
 		result.append(arg)
-		if args is None: break
 	return result, args
 
 def on_info_escape(pointer, name, arguments):
-	result = ''
-	for c in arguments:
-		if c == '\\':
-			result += '\\\\'
-		elif c == ',':
-			result += '\\,'
-		else:
-			result +=c
-	return result
+	if profile_counts: profile_counts.infos += 1
+	# Backslashes first, so the backslashes escaping commas are not escaped again.
+	return arguments.replace('\\', '\\\\').replace(',', '\\,')
 
 def on_info_replace(pointer, name, arguments):
+	if profile_counts: profile_counts.infos += 1
 	arguments, rest = parse_args(arguments, 3)
 	if rest or len(arguments) < 3:
 		log('usage: ${{info:{0},old,new,text}}'.format(name))
@@ -776,33 +1685,51 @@ def on_info_replace(pointer, name, arguments):
 
 	return text.replace(old, new)
 
-def on_info_order(pointer, name, arguments):
-	arguments, rest = parse_args(arguments)
-	if len(arguments) < 1:
-		log('usage: ${{info:{0},value,first,second,third,...}}'.format(name))
-		return ''
+def parse_order(options):
+	'''
+	Parse the options of the autosort_order info into a table of zero-padded results by option,
+	and the result for values not in the table.
+	'''
+	keys, rest = parse_args(options)
 
-	value = arguments[0]
-	keys  = arguments[1:]
-	if not keys: return '0'
+	# Pad results with leading zeros to make sure string sorting works.
+	width = len(str(len(keys)))
+	table = {}
+	for i, key in enumerate(keys):
+		if key not in table: table[key] = '{0:0{1}}'.format(i, width)
 
-	# Find the value in the keys (or '*' if we can't find it)
-	result = list_find(keys, value)
-	if result is None: result = list_find(keys, '*')
-	if result is None: result = len(keys)
+	# Values not in the table go to the position of '*', or last.
+	default = table.get('*', '{0:0{1}}'.format(len(keys), width))
+	return table, default
 
-	# Pad result with leading zero to make sure string sorting works.
-	width = int(math.log10(len(keys))) + 1
-	return '{0:0{1}}'.format(result, width)
+def on_info_order(pointer, name, arguments):
+	if profile_counts: profile_counts.infos += 1
+	result = order_results.get(arguments)
+	if result is not None: return result
+
+	value, options = parse_arg(arguments)
+	if options is None:
+		result = '0'
+	else:
+		order = order_tables.get(options)
+		if order is None:
+			order = parse_order(options)
+			order_tables.set(options, order)
+		table, default = order
+		result = table.get(value, default)
+
+	order_results.set(arguments, result)
+	return result
 
 
 def on_autosort_command(data, buffer, args):
 	''' Called when the autosort command is invoked. '''
 	try:
 		return call_command(buffer, ['/autosort'], args, {
-			' ':      command_sort,
-			'sort':   command_sort,
-			'debug':  command_debug,
+			' ':       command_sort,
+			'sort':    command_sort,
+			'debug':   command_debug,
+			'profile': command_profile,
 
 			'rules': {
 				' ':         command_rule_list,
@@ -873,7 +1800,7 @@ def on_autosort_complete(data, name, buffer, completion):
 	if prefix[-1] != ' ': words = words[:-1]
 
 	if len(words) == 0:
-		add_completions(completion, ['debug', 'helpers', 'rules', 'sort'])
+		add_completions(completion, ['debug', 'helpers', 'profile', 'rules', 'sort'])
 	elif words[0] == 'rules':
 		return autosort_complete_rules(words[1:], completion)
 	elif words[0] == 'helpers':
@@ -883,11 +1810,16 @@ def on_autosort_complete(data, name, buffer, completion):
 command_description = r'''{*white}# General commands{reset}
 
 {*white}/autosort {brown}sort{reset}
-Manually trigger the buffer sorting.
+Manually trigger the buffer sorting, computing the sort key of every buffer again.
 
 {*white}/autosort {brown}debug{reset}
 Show the evaluation results of the sort rules for each buffer.
 
+{*white}/autosort {brown}profile{reset}
+Evaluate every sort rule and helper variable separately for each buffer and show
+their cost, with the number of weechat eval and info calls, most expensive first.
+Also shows the most expensive buffers and the helper variables no rule uses.
+
 
 {*white}# Sorting rule commands{reset}
 
@@ -979,6 +1911,22 @@ considered for sorting purposes.
 You can debug your sort rules with the `{*default}/autosort debug{reset}` command, which will
 print the evaluation results of each rule for each buffer.
 
+The evaluation results of a buffer are cached, and only computed again when the
+buffer is opened, renamed, merged or unmerged, when one of its local variables
+changes, or when the autosort configuration changes. If your rules depend on
+anything else, use `{*default}/autosort sort{reset}` to compute them again.
+
+With {cyan}autosort.sorting.persist_keys{reset} enabled, the evaluation results are saved by
+buffer name when autosort is unloaded. After a restart, buffers with a saved
+result are sorted with it right away, and the rules are evaluated shortly after
+to confirm it.
+
+Simple expressions (literal text, buffer names, local variables, helper
+variables, {cyan}${{info:...}}{reset} and {cyan}${{if:...}}{reset} with a single {cyan}=={reset} or {cyan}!={reset} comparison)
+are evaluated by autosort itself, anything else is passed to weechat eval.
+With {cyan}autosort.sorting.batch_eval{reset} enabled, the expressions passed to weechat eval
+for a buffer are evaluated together, with a single call.
+
 {*brown}NOTE:{reset} The sort rules for version 3 are not compatible with version 2 or vice
 versa. You will have to manually port your old rules to version 3 if you have any.
 
@@ -988,6 +1936,8 @@ readable. They can be used in the main sort rules as variables. For example,
 a helper variable named `{cyan}foo{reset}` can be accessed in a main rule with the
 string `{cyan}${{foo}}{reset}`.
 
+Helper variables are only evaluated for a buffer when a rule uses them.
+
 {*white}# Automatic or manual sorting{reset}
 By default, autosort will automatically sort your buffer list whenever a buffer
 is opened, merged, unmerged or renamed. This should keep your buffers sorted in
@@ -995,6 +1945,12 @@ almost all situations. However, you may wish to change the list of signals that
 cause your buffer list to be sorted. Simply edit the `{cyan}autosort.sorting.signals{reset}`
 option to add or remove any signal you like.
 
+After a signal, autosort waits for {cyan}autosort.sorting.signal_delay{reset} milliseconds
+before sorting. While signals keep arriving, the delay grows up to
+{cyan}autosort.sorting.signal_delay_max{reset}, and {cyan}autosort.sorting.max_cpu{reset} limits how much
+time is spent sorting. To sort only once after autojoining channels, set
+{cyan}autosort.sorting.autojoin_hold{reset} to the time without signals after which joining is done.
+
 If you remove all signals you can still sort your buffers manually with the
 `{*default}/autosort sort{reset}` command. To prevent all automatic sorting, the option
 `{cyan}autosort.sorting.sort_on_config_change{reset}` should also be disabled.
@@ -1038,9 +1994,15 @@ info_escape_description = (
 info_escape_arguments = 'text'
 
 
-if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "", ""):
+if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "on_unload", ""):
 	config = Config('autosort')
 
+	order_tables  = LRUCache(256)
+	order_results = LRUCache(4096)
+	registry      = BufferRegistry()
+	scheduler     = SortScheduler()
+	load_keys()
+
 	colors = {
 		'default':  weechat.color('default'),
 		'reset':    weechat.color('reset'),
@@ -1072,4 +2034,11 @@ if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE,
 	weechat.hook_info('autosort_replace', info_replace_description, info_replace_arguments, 'on_info_replace', '')
 	weechat.hook_info('autosort_order',   info_order_description,   info_order_arguments,   'on_info_order',   '')
 
+	for signal in ('buffer_opened', 'buffer_closed', 'buffer_renamed', 'buffer_merged', 'buffer_unmerged',
+	               'buffer_localvar_added', 'buffer_localvar_changed', 'buffer_localvar_removed'):
+		weechat.hook_signal(signal, 'on_buffer_changed', '')
+	for signal in ('buffer_opened', 'buffer_closed', 'buffer_merged', 'buffer_unmerged', 'buffer_moved'):
+		weechat.hook_signal(signal, 'on_buffer_list_changed', '')
+	weechat.hook_timer(registry_check_interval * 1000, 0, 0, 'on_registry_check_timeout', '')
+
 	apply_config()
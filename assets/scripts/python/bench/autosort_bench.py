@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Offline benchmark for autosort.py
+#
+# Runs the script against the stand-in weechat module of this directory, on
+# synthetic buffer lists (100, 1k and 10k buffers by default, across many
+# servers, with merged groups and buffers opened in random order), and
+# reports for every size:
+#
+#   - full:    sorting the shuffled buffer list from scratch
+#   - resort:  sorting it again, with nothing to move
+#   - opened:  one buffer_opened signal, until the timers are done
+#   - burst:   a join burst of 500 buffer_opened signals, one every
+#              --join-interval ms of the clock of the stand-in module
+#
+# with the wall time, the number of sorts, the string_eval_expression and
+# buffer_set calls and the calls into the weechat API in total. Timers run on
+# the clock of the stand-in module, which skips the waits, so the burst
+# measures what the scheduler of the script decides, not how long it waits.
+#
+# With --json, the results are also written to a file, to track them over
+# time or against another version of the script:
+#
+#   python3 bench/autosort_bench.py --json /tmp/autosort.json
+#   git show HEAD~5:assets/scripts/python/autosort.py > /tmp/old.py
+#   python3 bench/autosort_bench.py --script /tmp/old.py --json /tmp/old.json
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import weechat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'autosort.py')
+
+NETWORKS = ('libera', 'oftc', 'efnet', 'rizon', 'ircnet', 'hackint', 'snoonet', 'quakenet')
+
+WORDS = ('python', 'weechat', 'linux', 'rust', 'go', 'music', 'games', 'offtopic',
+         'dev', 'help', 'ops', 'news', 'chat', 'crypto', 'lounge', 'books')
+
+
+def buffer_specs(count, rng):
+    ''' Make the (plugin, name, localvars) of count buffers: the core and
+    irc_raw buffers, a few script buffers, and servers with channels and
+    private buffers, one server per 50 buffers. '''
+    specs = [('core', 'weechat', {}), ('irc', 'irc_raw', {})]
+    for i in range(min(5, count // 20)):
+        specs.append(('python', 'script%d' % i, {'script_name': 'script%d' % i}))
+
+    servers = ['%s%d' % (NETWORKS[i % len(NETWORKS)], i // len(NETWORKS)) for i in range(max(2, count // 50))]
+    for server in servers:
+        specs.append(('irc', 'server.' + server, {'type': 'server', 'server': server}))
+    i = 0
+    while len(specs) < count:
+        server = rng.choice(servers)
+        if rng.random() < 0.85:
+            channel = '#%s-%s%d' % (rng.choice(WORDS), rng.choice(WORDS), i)
+            if rng.random() < 0.1:
+                channel = '##' + channel[1:]
+            specs.append(('irc', '%s.%s' % (server, channel), {'type': 'channel', 'server': server, 'channel': channel}))
+        else:
+            nick = 'nick%d' % i
+            specs.append(('irc', '%s.%s' % (server, nick), {'type': 'private', 'server': server, 'channel': nick}))
+        i += 1
+    return specs
+
+def populate(count, rng, merged):
+    ''' Reset the stand-in module to count buffers opened in random order,
+    with a fraction of the channels merged with another buffer. '''
+    weechat.reset()
+    specs = buffer_specs(count, rng)
+    core = specs[0]
+    rest = specs[1:]
+    rng.shuffle(rest)
+    pointers = [weechat.add_buffer(plugin, name, localvars) for plugin, name, localvars in [core] + rest]
+
+    # Merge some channels into the buffer of another channel of any server
+    channels = [pointer for pointer in pointers if weechat.buffers[pointer].localvars.get('type') == 'channel']
+    for pointer in rng.sample(channels, int(len(channels) * merged)):
+        target = rng.choice(channels)
+        if weechat.buffers[target].group is not weechat.buffers[pointer].group:
+            weechat.merge_buffer(pointer, target)
+    return specs
+
+def load_script(path, options):
+    ''' Run the script as WeeChat would and return its globals. '''
+    for option, value in options.items():
+        weechat.options[option] = value
+    namespace = {'__name__': '__main__', '__file__': path}
+    with open(path, encoding='utf-8') as source:
+        exec(compile(source.read(), path, 'exec'), namespace)
+    # Let the timers of the script see the clock of the stand-in module
+    namespace['perf_counter'] = weechat.clock
+    weechat.run_timers()
+    return namespace
+
+def count_sorts(script):
+    ''' Wrap do_sort in the script to count the sorts. '''
+    sorts = [0]
+    do_sort = script['do_sort']
+    def counted(*args, **kwargs):
+        sorts[0] += 1
+        return do_sort(*args, **kwargs)
+    script['do_sort'] = counted
+    return sorts
+
+def measure(name, count, action, sorts):
+    ''' Run action and return a row of results. '''
+    weechat.calls.clear()
+    sorts[0] = 0
+    start = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - start
+    return {
+        'scenario': name,
+        'buffers': count,
+        'ms': elapsed * 1e3,
+        'sorts': sorts[0],
+        'evals': weechat.calls['string_eval_expression'],
+        'buffer_sets': weechat.calls['buffer_set'],
+        'calls': sum(weechat.calls.values()),
+    }
+
+def run_until(deadline):
+    ''' Run the timers due on the clock of the stand-in module by deadline. '''
+    while any(hook['type'] == 'timer' and hook['max_calls'] == 1 and hook['due'] <= deadline
+              for hook in weechat.hooks):
+        weechat.run_timers(1)
+
+def join(server, name):
+    return weechat.add_buffer('irc', '%s.%s' % (server, name),
+                              {'type': 'channel', 'server': server, 'channel': name}, signal=True)
+
+def run(count, args):
+    ''' Run every scenario on count buffers and return the rows. '''
+    rng = random.Random(args.seed + count)
+    specs = populate(count, rng, args.merged)
+    servers = sorted(set(localvars['server'] for plugin, name, localvars in specs if 'server' in localvars))
+
+    # Sorting on load would be the full sort, run it separately, and keys
+    # saved by an earlier run would make it cheaper
+    options = dict(args.options)
+    options.setdefault('autosort.sorting.sort_on_config_change', 'off')
+    options.setdefault('autosort.sorting.persist_keys', 'off')
+    script = load_script(args.script, options)
+    sorts = count_sorts(script)
+
+    rows = []
+    rows.append(measure('full', count, lambda: script['do_sort'](), sorts))
+    rows.append(measure('resort', count, lambda: script['do_sort'](), sorts))
+
+    def opened():
+        join(rng.choice(servers), '#opened')
+        weechat.run_timers()
+    rows.append(measure('opened', count, opened, sorts))
+
+    def burst():
+        for i in range(args.burst):
+            weechat._skipped += args.join_interval / 1000.0
+            run_until(weechat.clock())
+            join(servers[i % len(servers)], '#burst%d' % i)
+        weechat.run_timers()
+    rows.append(measure('burst', count, burst, sorts))
+
+    # The buffers must end up in the order of a full sort
+    order = [buffer.pointer for buffer in weechat.ordered_buffers()]
+    for cache in ('key_cache', 'buffer_properties'):
+        script.get(cache, {}).clear()
+    script['do_sort']()
+    if [buffer.pointer for buffer in weechat.ordered_buffers()] != order:
+        print('%d buffers: order after the burst differs from a full sort' % count, file=sys.stderr)
+    return rows
+
+def print_row(row):
+    print('%-8s %7d %10.1f %6d %8d %8d %9d' % (
+        row['scenario'], row['buffers'], row['ms'], row['sorts'], row['evals'],
+        row['buffer_sets'], row['calls']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark autosort.py outside of WeeChat.')
+    parser.add_argument('--script', default=SCRIPT, help='script to run (default: %(default)s)')
+    parser.add_argument('--buffers', default='100,1000,10000',
+                        type=lambda value: [int(n) for n in value.split(',') if n],
+                        help='buffers of the synthetic buffer lists, comma separated (default: %(default)s)')
+    parser.add_argument('--merged', default=0.05, type=float,
+                        help='fraction of the channels merged with another buffer (default: %(default)s)')
+    parser.add_argument('--burst', default=500, type=int, help='buffers opened by the join burst (default: %(default)s)')
+    parser.add_argument('--join-interval', default=2.0, type=float,
+                        help='milliseconds between the joins of the burst (default: %(default)s)')
+    parser.add_argument('--set', dest='options', action='append', default=[], metavar='OPTION=VALUE',
+                        type=lambda value: tuple(value.split('=', 1)),
+                        help='set a weechat option, like autosort.sorting.batch_eval=off')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic buffer lists')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to a JSON file')
+    args = parser.parse_args()
+
+    for option in args.options:
+        if len(option) != 2:
+            parser.error('expected OPTION=VALUE, got %r' % option[0])
+
+    print('%-8s %7s %10s %6s %8s %8s %9s' % ('scenario', 'buffers', 'ms', 'sorts', 'evals', 'moves', 'calls'))
+    rows = []
+    for count in args.buffers:
+        for row in run(count, args):
+            print_row(row)
+            rows.append(row)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({
+                'script': os.path.abspath(args.script),
+                'options': dict(args.options),
+                'seed': args.seed,
+                'merged': args.merged,
+                'burst': args.burst,
+                'join_interval_ms': args.join_interval,
+                'results': rows,
+            }, output, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
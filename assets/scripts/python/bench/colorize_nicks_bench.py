@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Offline benchmark for colorize_nicks.py
+#
+# Runs the script against the stand-in weechat module of this directory, on
+# synthetic channels (10, 1k and 10k nicks by default, with nicks that are
+# substrings of other nicks) and on replayed logger files, and reports for
+# the greedy, lazy and fallback paths:
+#
+#   - lines per second and the p50/p99 latency of colorize_cb
+#   - peak and retained memory allocated while colorizing (tracemalloc)
+#   - calls into the weechat API per line
+#   - the lines counted by the script on every matching path, when it keeps
+#     statistics (info colorize_nicks_stats)
+#
+# With --compare, it runs the script and a reference copy of it on the same
+# lines and reports every line where their colorize_cb output differs, so a
+# faster engine can be checked against the current one:
+#
+#   git show HEAD:assets/scripts/python/colorize_nicks.py > /tmp/reference.py
+#   python3 bench/colorize_nicks_bench.py --compare /tmp/reference.py
+#
+# Logger files are replayed with --replay, one buffer per file. The nicks of
+# the buffer are the ones seen in the prefixes of the file.
+#
+#   python3 bench/colorize_nicks_bench.py --replay ~/.weechat/logs/irc.*.log
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+import weechat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'colorize_nicks.py')
+
+# match_limit is for reference copies of the script older than time_budget
+MODES = {
+    # Greedy matching, with a limit that is never reached
+    'greedy': {'greedy_matching': 'on', 'time_budget': '0', 'match_limit': '1000'},
+    # Lazy matching only
+    'lazy': {'greedy_matching': 'off'},
+    # Greedy matching that gives up on every line and falls back to lazy
+    'fallback': {'greedy_matching': 'on', 'time_budget': '1', 'match_limit': '1'},
+}
+
+WORDS = ('the', 'a', 'is', 'it', 'on', 'in', 'to', 'and', 'of', 'for', 'you',
+         'that', 'this', 'what', 'just', 'like', 'lol', 'ok', 'no', 'yes',
+         'server', 'channel', 'python', 'weechat', 'script', 'broken', 'works',
+         'again', 'why', 'when', 'there', 'here', 'thanks', 'anyone', 'know')
+
+NICK_CHARS = string.ascii_letters + string.digits + '_-[]\\`^{}|'
+
+LOG_PREFIXES = ('-->', '<--', '--', '*', '=!=', ' *', '')
+
+
+# Folds nicks the way IRC servers compare them by default (RFC 1459)
+CASEMAP = str.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^')
+
+def synthetic_nicks(count, rng):
+    ''' Make count nicks, unique for an IRC server, a fifth of them built
+    around another nick (prefixes, suffixes, brackets) so nicks overlap in
+    lines. '''
+    nicks = []
+    seen = set()
+    while len(nicks) < count:
+        if nicks and rng.random() < 0.2:
+            base = rng.choice(nicks)
+            nick = rng.choice((base[:max(2, len(base) // 2)], base + '_',
+                               base + '|away', '[' + base + ']', base + '2',
+                               rng.choice(WORDS) + base))
+        else:
+            nick = rng.choice(string.ascii_letters) + ''.join(
+                rng.choice(NICK_CHARS) for _ in range(rng.randint(1, 11)))
+        if nick.translate(CASEMAP) not in seen:
+            seen.add(nick.translate(CASEMAP))
+            nicks.append(nick)
+    return nicks
+
+def mention(nick, rng):
+    ''' A nick the way it shows up in a message. '''
+    return rng.choice(('%s', '%s:', '%s,', '@%s', '<%s>', '(%s)', "%s's",
+                       'https://example.com/~%s/x', '%s!', '%s')) % nick
+
+def synthetic_lines(nicks, count, rng):
+    ''' Make count chat lines mentioning nicks; one line in fifty lists many
+    nicks, like a mass highlight or a names reply. '''
+    lines = []
+    for _ in range(count):
+        if rng.random() < 0.02:
+            words = [rng.choice(nicks) for _ in range(min(40, len(nicks)))]
+        else:
+            words = []
+            for _ in range(rng.randint(3, 25)):
+                if rng.random() < 0.12:
+                    words.append(mention(rng.choice(nicks), rng))
+                else:
+                    words.append(rng.choice(WORDS))
+        lines.append(' '.join(words))
+    return lines
+
+def replay_lines(path):
+    ''' Read the messages and nicks of a logger file. '''
+    lines = []
+    nicks = set()
+    with open(path, encoding='utf-8', errors='replace') as log:
+        for row in log:
+            fields = row.rstrip('\n').split('\t', 2)
+            if len(fields) < 3:
+                continue
+            prefix, message = fields[1], fields[2]
+            if prefix in LOG_PREFIXES:
+                # Joins, parts and actions start with the nick
+                if prefix in ('-->', '<--', ' *', '*') and message:
+                    nicks.add(message.split(' ', 1)[0])
+            else:
+                nicks.add(prefix.lstrip('~&@%+!'))
+            lines.append(message)
+    nicks.discard('')
+    return sorted(nicks), lines
+
+
+def load_script(path):
+    ''' Run a script as WeeChat would and return its globals. '''
+    namespace = {'__name__': '__main__', '__file__': path}
+    with open(path, encoding='utf-8') as source:
+        exec(compile(source.read(), path, 'exec'), namespace)
+    return namespace
+
+def setup(name, nicks, mode, args):
+    ''' Reset the stand-in weechat module to one channel holding the nicks,
+    with the options of the mode. '''
+    weechat.reset()
+    weechat.options['colorize_nicks.look.line_cache_size'] = str(args.line_cache)
+    for option, value in MODES[mode].items():
+        weechat.options['colorize_nicks.look.' + option] = value
+    buffer = weechat.add_buffer('irc', 'bench.#%s' % name, {
+        'type': 'channel', 'server': 'bench', 'channel': '#' + name, 'nick': nicks[0]}, nicks)
+    return buffer, '%s;irc_privmsg,notify_message,log1' % buffer
+
+def percentile(values, fraction):
+    ''' Nearest-rank percentile of sorted values. '''
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def run(name, nicks, lines, mode, args):
+    ''' Time colorize_cb over the lines and return a row of results. '''
+    buffer, modifier_data = setup(name, nicks, mode, args)
+    start = time.perf_counter()
+    script = load_script(args.script)
+    colorize_cb = script['colorize_cb']
+    # The first line fills the nick tables of the buffer
+    colorize_cb('', 'weechat_print', modifier_data, '')
+    weechat.run_timers()
+    load = time.perf_counter() - start
+
+    calls = sum(weechat.calls.values())
+    latencies = []
+    perf_counter = time.perf_counter
+    for line in lines:
+        start = perf_counter()
+        colorize_cb('', 'weechat_print', modifier_data, line)
+        latencies.append(perf_counter() - start)
+    calls = sum(weechat.calls.values()) - calls
+
+    # Lines by matching path, as counted by the script; the first line is
+    # skipped, having no nicks
+    stats = weechat.info_get('colorize_nicks_stats', '')
+    paths = '-'
+    if stats:
+        paths = ' '.join('%s:%d' % (path, value['count'])
+                         for path, value in sorted(json.loads(stats).items()) if value['count'])
+
+    row = {
+        'source': name,
+        'nicks': len(nicks),
+        'mode': mode,
+        'lines': len(lines),
+        'load_ms': load * 1e3,
+        'lines_per_sec': len(lines) / (sum(latencies) or 1e-9),
+        'p50_us': 0.0,
+        'p99_us': 0.0,
+        'calls_per_line': calls / float(len(lines) or 1),
+        'peak_kib': None,
+        'retained_kib': None,
+        'paths': paths,
+    }
+    if latencies:
+        latencies.sort()
+        row['p50_us'] = percentile(latencies, 0.50) * 1e6
+        row['p99_us'] = percentile(latencies, 0.99) * 1e6
+
+    if args.alloc:
+        # Second pass, as tracing slows every allocation down
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for line in lines:
+            colorize_cb('', 'weechat_print', modifier_data, line)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        row['peak_kib'] = (peak - before) / 1024.0
+        row['retained_kib'] = (current - before) / 1024.0
+    return row
+
+def compare(name, nicks, lines, mode, args):
+    ''' Run the script and the reference on the same lines and return the
+    lines where they differ as (line, expected, got). '''
+    buffer, modifier_data = setup(name, nicks, mode, args)
+    script = load_script(args.script)['colorize_cb']
+    reference = load_script(args.compare)['colorize_cb']
+    weechat.run_timers()
+    differences = []
+    for line in lines:
+        expected = reference('', 'weechat_print', modifier_data, line)
+        got = script('', 'weechat_print', modifier_data, line)
+        if got != expected:
+            differences.append((line, expected, got))
+    return differences
+
+def sources(args):
+    ''' Yield the (name, nicks, lines) to run on. '''
+    for count in args.nicks:
+        rng = random.Random(args.seed + count)
+        nicks = synthetic_nicks(count, rng)
+        yield 'synthetic', nicks, synthetic_lines(nicks, args.lines, rng)
+    for path in args.replay:
+        nicks, lines = replay_lines(path)
+        if nicks and lines:
+            yield os.path.basename(path), nicks, lines
+        else:
+            print('%s: no messages or nicks found, skipping' % path, file=sys.stderr)
+
+def print_row(row):
+    alloc = '        -        -'
+    if row['peak_kib'] is not None:
+        alloc = '%9.1f %8.1f' % (row['peak_kib'], row['retained_kib'])
+    print('%-24s %6d %-8s %6d %8.1f %10.0f %8.1f %8.1f %s %6.2f  %s' % (
+        row['source'][:24], row['nicks'], row['mode'], row['lines'], row['load_ms'],
+        row['lines_per_sec'], row['p50_us'], row['p99_us'], alloc, row['calls_per_line'],
+        row['paths']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark colorize_nicks.py outside of WeeChat.')
+    parser.add_argument('--script', default=SCRIPT, help='script to run (default: %(default)s)')
+    parser.add_argument('--nicks', default='10,1000,10000',
+                        type=lambda value: [int(n) for n in value.split(',') if n],
+                        help='nicks of the synthetic channels, comma separated (default: %(default)s)')
+    parser.add_argument('--lines', default=2000, type=int, help='lines per synthetic channel (default: %(default)s)')
+    parser.add_argument('--modes', default=','.join(MODES), type=lambda value: value.split(','),
+                        help='matching paths to run, comma separated (default: %(default)s)')
+    parser.add_argument('--replay', nargs='*', default=[], metavar='LOG', help='logger files to replay')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic channels')
+    parser.add_argument('--line-cache', default=0, type=int,
+                        help='colorize_nicks.look.line_cache_size (default: %(default)s, no cache)')
+    parser.add_argument('--no-alloc', dest='alloc', action='store_false', help='skip the tracemalloc pass')
+    parser.add_argument('--compare', metavar='REFERENCE',
+                        help='check the output of the script against a reference script instead of timing it')
+    parser.add_argument('--show', default=5, type=int, help='differences to show per run with --compare')
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error('unknown mode %r, expected one of %s' % (mode, ', '.join(MODES)))
+
+    if args.compare:
+        failed = False
+        for name, nicks, lines in sources(args):
+            for mode in args.modes:
+                differences = compare(name, nicks, lines, mode, args)
+                print('%-24s %6d %-8s %6d lines, %d different' % (
+                    name[:24], len(nicks), mode, len(lines), len(differences)))
+                for line, expected, got in differences[:args.show]:
+                    print('    line:      %r\n    reference: %r\n    script:    %r' % (line, expected, got))
+                failed = failed or bool(differences)
+        return 1 if failed else 0
+
+    print('%-24s %6s %-8s %6s %8s %10s %8s %8s %9s %8s %6s  %s' % (
+        'source', 'nicks', 'mode', 'lines', 'load ms', 'lines/s', 'p50 us',
+        'p99 us', 'peak KiB', 'kept KiB', 'calls', 'paths'))
+    for name, nicks, lines in sources(args):
+        for mode in args.modes:
+            print_row(run(name, nicks, lines, mode, args))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+#
+# Stand-in for the weechat module, used to run the scripts outside of WeeChat
+# for benchmarks. It implements just enough of the plugin API for the scripts
+# of this repository: configuration, buffers with local variables and
+# nicklists, the gui_buffers hdata list, buffer moves, a subset of eval,
+# infolists, colors, infos and hooks. Timers never fire on their own, call
+# run_timers() to run them: it skips the clock() to the time each timer is due.
+#
+# Every API call is counted in `calls`, so benchmarks can report how many
+# round trips into WeeChat a code path makes.
+
+import sys
+import time
+from collections import Counter
+
+WEECHAT_RC_OK = 0
+WEECHAT_RC_OK_EAT = 1
+WEECHAT_RC_ERROR = -1
+
+WEECHAT_LIST_POS_SORT = 'sort'
+WEECHAT_LIST_POS_BEGINNING = 'beginning'
+WEECHAT_LIST_POS_END = 'end'
+
+calls = Counter()
+
+# Values of the WeeChat options, by full name
+options = {}
+
+# Buffers by pointer
+buffers = {}
+
+# Groups of merged buffers in display order, as lists of Buffer
+groups = []
+
+# Display order of the buffers and numbers of the groups, computed on demand
+_order = None
+
+# Hooks as dicts with the namespace of the script that created them
+hooks = []
+
+# Lines printed with prnt() as (buffer, message)
+printed = []
+
+current_namespace = None
+
+DEFAULT_OPTIONS = {
+    'weechat.color.chat_nick_colors': 'cyan,magenta,green,brown,lightblue,default,lightcyan,lightmagenta,lightgreen,blue',
+    'weechat.color.chat_nick_self': 'white',
+    'weechat.look.nick_color_force': '',
+    'weechat.look.nick_color_hash': 'djb2',
+    'weechat.look.nick_color_hash_salt': '',
+    'weechat.look.nick_color_stop_chars': '_|[',
+}
+
+def _count(function):
+    def wrapper(*args):
+        calls[function.__name__] += 1
+        return function(*args)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+def reset():
+    ''' Forget all options, buffers, hooks and counters. '''
+    global current_namespace, _order
+    calls.clear()
+    options.clear()
+    options.update(DEFAULT_OPTIONS)
+    buffers.clear()
+    del groups[:]
+    _order = None
+    del hooks[:]
+    del printed[:]
+    current_namespace = None
+
+reset()
+
+
+# Scripts
+
+@_count
+def register(name, author, version, license, description, shutdown_function, charset):
+    ''' Register the calling script; its globals resolve the hook callbacks. '''
+    global current_namespace
+    current_namespace = sys._getframe(2).f_globals
+    return 1
+
+@_count
+def prnt(buffer, message):
+    printed.append((buffer, message))
+
+
+# Configuration
+
+@_count
+def config_new(name, callback, data):
+    return name
+
+@_count
+def config_new_section(config_file, name, *args):
+    return '%s.%s' % (config_file, name)
+
+@_count
+def config_new_option(config_file, section, name, type, description, string_values,
+                      min, max, default, value, null_value_allowed, *args):
+    full_name = '%s.%s' % (section, name)
+    if full_name not in options:
+        options[full_name] = value
+    return full_name
+
+@_count
+def config_read(config_file):
+    return WEECHAT_RC_OK
+
+@_count
+def config_write(config_file):
+    return WEECHAT_RC_OK
+
+@_count
+def config_free(config_file):
+    pass
+
+@_count
+def config_get(name):
+    return name if name in options else ''
+
+@_count
+def config_string(option):
+    return options.get(option, '')
+
+@_count
+def config_integer(option):
+    try:
+        return int(options.get(option, 0) or 0)
+    except ValueError:
+        return 0
+
+@_count
+def config_boolean(option):
+    return 1 if options.get(option) in ('on', '1', 1, True) else 0
+
+@_count
+def config_option_set(option, value, run_callback):
+    set_option(option, value, run_callback)
+    return 2
+
+def set_option(name, value, run_callback=True):
+    ''' Change an option, running the config hooks matching it. '''
+    options[name] = value
+    if run_callback:
+        for hook in list(hooks):
+            if hook['type'] == 'config' and _match(hook['mask'], name):
+                _call(hook, hook['data'], name, value)
+
+def _match(mask, name):
+    if mask.endswith('*'):
+        return name.startswith(mask[:-1])
+    return mask == name
+
+
+# Colors
+
+@_count
+def color(name):
+    return '\x19[%s]' % name
+
+def nick_color_name(nick):
+    ''' Find the color name of a nick the way gui_nick_find_color_name does. '''
+    stop_chars = options['weechat.look.nick_color_stop_chars']
+    other_char = False
+    for i, char in enumerate(nick):
+        if char not in stop_chars:
+            other_char = True
+        elif other_char:
+            nick = nick[:i]
+            break
+
+    forced = {}
+    for item in options['weechat.look.nick_color_force'].split(';'):
+        name, separator, value = item.partition(':')
+        if separator:
+            forced[name] = value
+    if nick in forced or nick.lower() in forced:
+        return forced.get(nick) or forced[nick.lower()]
+
+    colors = [c.strip() for c in options['weechat.color.chat_nick_colors'].split(',') if c.strip()]
+    if not colors:
+        return 'default'
+    algorithm = options['weechat.look.nick_color_hash']
+    mask = 0xffffffff if algorithm.endswith('_32') else 0xffffffffffffffff
+    key = options['weechat.look.nick_color_hash_salt'] + nick
+    if algorithm.startswith('sum'):
+        value = sum(ord(char) for char in key) & mask
+    else:
+        value = 5381
+        for char in key:
+            value = (value ^ ((value << 5) + (value >> 2) + ord(char))) & mask
+    return colors[value % len(colors)]
+
+
+# Infos
+
+@_count
+def info_get(name, arguments):
+    if name == 'nick_color':
+        return color(nick_color_name(arguments))
+    if name == 'nick_color_name':
+        return nick_color_name(arguments)
+    if name in ('weechat_dir', 'weechat_data_dir'):
+        return options.get('__data_dir__', '')
+    if name == 'irc_server_isupport_value':
+        server, feature = arguments.split(',', 1)
+        return options.get('__isupport__.%s.%s' % (server, feature), '')
+    for hook in hooks:
+        if hook['type'] == 'info' and hook['name'] == name:
+            return _call(hook, hook['data'], name, arguments)
+    return ''
+
+
+# Buffers
+
+class Buffer(object):
+    def __init__(self, pointer, plugin, name, localvars, nicks):
+        self.pointer = pointer
+        self.plugin = plugin
+        self.name = name
+        self.short_name = name
+        self.localvars = dict(localvars)
+        self.localvars.setdefault('plugin', plugin)
+        self.localvars.setdefault('name', name)
+        self.nicks = list(nicks)
+        self.group = None
+        self.input = ''
+
+    @property
+    def full_name(self):
+        return '%s.%s' % (self.plugin, self.name)
+
+    @property
+    def number(self):
+        # Between moves, finding the group is cheaper than indexing them all
+        if _order is None:
+            return groups.index(self.group) + 1
+        return _order[1][id(self.group)] + 1
+
+def _invalidate_order():
+    global _order
+    _order = None
+
+def _index():
+    ''' Return the buffers in display order, the index of every group by id
+    and the position of every buffer in display order by pointer. '''
+    global _order
+    if _order is None:
+        ordered = [buffer for group in groups for buffer in group]
+        _order = (ordered,
+                  dict((id(group), i) for i, group in enumerate(groups)),
+                  dict((buffer.pointer, i) for i, buffer in enumerate(ordered)))
+    return _order
+
+def _leave_group(buffer):
+    ''' Remove a buffer from its group, and the group if it is empty, which
+    renumbers the groups after it like buffer_auto_renumber. '''
+    group = buffer.group
+    group.remove(buffer)
+    if not group:
+        groups.remove(group)
+    buffer.group = None
+    _invalidate_order()
+
+def _insert_group(buffer, index):
+    buffer.group = [buffer]
+    groups.insert(index, buffer.group)
+    _invalidate_order()
+
+def add_buffer(plugin, name, localvars=(), nicks=(), pointer=None, signal=False, number=None):
+    ''' Create a buffer at the end of the buffer list, or at number shifting
+    the buffers after it, and return its pointer. With signal, send
+    buffer_opened like WeeChat does. '''
+    if pointer is None:
+        pointer = '0x%x' % (0x1000 + len(buffers) * 0x10 + sum(map(ord, name)) * 0x100000)
+        while pointer in buffers:
+            pointer = '0x%x' % (int(pointer, 16) + 1)
+    buffer = Buffer(pointer, plugin, name, dict(localvars), nicks)
+    buffers[pointer] = buffer
+    _insert_group(buffer, len(groups) if number is None else max(0, min(number - 1, len(groups))))
+    if signal:
+        send_signal('buffer_opened', pointer)
+    return pointer
+
+def close_buffer(pointer):
+    ''' Close a buffer, renumbering the ones after it. '''
+    send_signal('buffer_closing', pointer)
+    _leave_group(buffers.pop(pointer))
+    send_signal('buffer_closed', pointer)
+
+def merge_buffer(pointer, target):
+    ''' Merge a buffer into the group of another one. '''
+    buffer = buffers[pointer]
+    _leave_group(buffer)
+    buffer.group = buffers[target].group
+    buffer.group.append(buffer)
+    send_signal('buffer_merged', pointer)
+
+def unmerge_buffer(pointer):
+    ''' Move a merged buffer right after its group, shifting the others. '''
+    buffer = buffers[pointer]
+    index = buffer.number
+    _leave_group(buffer)
+    _insert_group(buffer, index)
+    send_signal('buffer_unmerged', pointer)
+
+def set_localvar(pointer, name, value):
+    ''' Change a local variable of a buffer. '''
+    buffer = buffers[pointer]
+    signal = 'buffer_localvar_changed' if name in buffer.localvars else 'buffer_localvar_added'
+    buffer.localvars[name] = value
+    send_signal(signal, pointer)
+
+def ordered_buffers():
+    ''' Return the buffers in gui_buffers order: by number, merged buffers in
+    merge order. '''
+    return list(_index()[0])
+
+@_count
+def current_buffer():
+    return next(iter(buffers), '')
+
+@_count
+def buffer_search(plugin, name):
+    for buffer in buffers.values():
+        if buffer.plugin == plugin and buffer.name == name:
+            return buffer.pointer
+    return ''
+
+@_count
+def buffer_get_string(pointer, property):
+    buffer = buffers.get(pointer)
+    if buffer is None:
+        return ''
+    if property.startswith('localvar_'):
+        return buffer.localvars.get(property[len('localvar_'):], '')
+    if property == 'full_name':
+        return buffer.full_name
+    if property in ('name', 'short_name', 'plugin', 'input'):
+        return getattr(buffer, property)
+    return ''
+
+@_count
+def buffer_get_integer(pointer, property):
+    buffer = buffers.get(pointer)
+    if buffer is None:
+        return 0
+    if property == 'number':
+        return buffer.number
+    if property == 'input_pos':
+        return len(buffer.input)
+    if property == 'nicklist_nicks_count':
+        return len(buffer.nicks)
+    return 0
+
+@_count
+def buffer_set(pointer, property, value):
+    ''' Only the number property is supported: move the buffer and the
+    buffers merged with it, shifting the others. '''
+    buffer = buffers.get(pointer)
+    if buffer is None or property != 'number':
+        return
+    old_number = buffer.number
+    groups.pop(old_number - 1)
+    groups.insert(max(0, min(int(value) - 1, len(groups))), buffer.group)
+    _invalidate_order()
+    if buffer.number != old_number:
+        send_signal('buffer_moved', pointer)
+
+
+# Hdata
+
+@_count
+def hdata_get(name):
+    return name
+
+@_count
+def hdata_get_list(hdata, name):
+    ordered = _index()[0]
+    if name == 'gui_buffers':
+        return ordered[0].pointer if ordered else ''
+    if name == 'last_gui_buffer':
+        return ordered[-1].pointer if ordered else ''
+    return ''
+
+@_count
+def hdata_pointer(hdata, pointer, name):
+    if name in ('next_buffer', 'prev_buffer'):
+        ordered, numbers, positions = _index()
+        index = positions[pointer] + (1 if name == 'next_buffer' else -1)
+        return ordered[index].pointer if 0 <= index < len(ordered) else ''
+    return ''
+
+@_count
+def hdata_integer(hdata, pointer, name):
+    buffer = buffers.get(pointer)
+    return getattr(buffer, name, 0) if buffer is not None else 0
+
+@_count
+def hdata_string(hdata, pointer, name):
+    buffer = buffers.get(pointer)
+    if buffer is None:
+        return ''
+    if name == 'plugin_name':
+        return buffer.plugin
+    return getattr(buffer, name, '') or ''
+
+
+# Eval
+
+@_count
+def string_eval_expression(expression, pointers, extra_vars, options):
+    ''' Evaluate ${...} with buffer properties and local variables, extra
+    variables, infos and ${if:...}, with conditions using == and !=. '''
+    return _eval(expression, pointers.get('buffer', ''), extra_vars)
+
+def _split_top(text, separator):
+    ''' Split text at the first separator outside of ${...}. '''
+    depth = 0
+    i = 0
+    while i < len(text):
+        if text.startswith('${', i):
+            depth += 1
+            i += 2
+            continue
+        if text[i] == '}' and depth:
+            depth -= 1
+        elif depth == 0 and text.startswith(separator, i):
+            return text[:i], text[i + len(separator):]
+        i += 1
+    return text, None
+
+def _eval(text, buffer, extra_vars):
+    result = []
+    i = 0
+    while i < len(text):
+        start = text.find('${', i)
+        if start < 0:
+            result.append(text[i:])
+            break
+        result.append(text[i:start])
+        depth = 1
+        end = start + 2
+        while end < len(text) and depth:
+            if text.startswith('${', end):
+                depth += 1
+                end += 2
+                continue
+            if text[end] == '}':
+                depth -= 1
+            end += 1
+        result.append(_eval_var(text[start + 2:end - 1], buffer, extra_vars))
+        i = end
+    return ''.join(result)
+
+def _eval_condition(text, buffer, extra_vars):
+    for operator in ('==', '!='):
+        left, right = _split_top(text, operator)
+        if right is not None:
+            equal = _eval(left, buffer, extra_vars) == _eval(right, buffer, extra_vars)
+            return equal == (operator == '==')
+    value = _eval(text, buffer, extra_vars)
+    return value not in ('', '0')
+
+def _eval_var(name, buffer, extra_vars):
+    if name.startswith('if:'):
+        condition, branches = _split_top(name[3:], '?')
+        true = _eval_condition(condition, buffer, extra_vars)
+        if branches is None:
+            return '1' if true else '0'
+        if_true, if_false = _split_top(branches, ':')
+        return _eval(if_true if true else (if_false or ''), buffer, extra_vars)
+    name = _eval(name, buffer, extra_vars)
+    if name.startswith('info:'):
+        info_name, _, arguments = name[5:].partition(',')
+        return info_get(info_name, arguments)
+    if name in extra_vars:
+        return extra_vars[name]
+    if name.startswith('buffer.'):
+        variable = name[len('buffer.'):]
+        if variable.startswith('local_variables.'):
+            return buffer_get_string(buffer, 'localvar_' + variable[len('local_variables.'):])
+        if variable == 'number':
+            return str(buffer_get_integer(buffer, 'number'))
+        return buffer_get_string(buffer, variable)
+    return buffer_get_string(buffer, 'localvar_' + name)
+
+
+# Infolists
+
+class Infolist(object):
+    def __init__(self, items):
+        self.items = items
+        self.index = -1
+
+@_count
+def infolist_get(name, pointer, arguments):
+    items = []
+    if name == 'nicklist' and pointer in buffers:
+        items = [{'type': 'nick', 'name': nick} for nick in buffers[pointer].nicks]
+    elif name == 'buffer':
+        items = [{'pointer': buffer.pointer, 'name': buffer.name}
+                 for buffer in buffers.values()]
+    return Infolist(items)
+
+@_count
+def infolist_next(infolist):
+    infolist.index += 1
+    return 1 if infolist.index < len(infolist.items) else 0
+
+@_count
+def infolist_string(infolist, variable):
+    return infolist.items[infolist.index].get(variable, '')
+
+@_count
+def infolist_pointer(infolist, variable):
+    return infolist.items[infolist.index].get(variable, '')
+
+@_count
+def infolist_integer(infolist, variable):
+    return infolist.items[infolist.index].get(variable, 0)
+
+@_count
+def infolist_free(infolist):
+    pass
+
+
+# Hooks
+
+def _hook(type, **kwargs):
+    hook = dict(kwargs, type=type, namespace=current_namespace)
+    hooks.append(hook)
+    return hook
+
+def _call(hook, *args):
+    return hook['namespace'][hook['callback']](*args)
+
+@_count
+def hook_signal(signal, callback, data):
+    return _hook('signal', signal=signal, callback=callback, data=data)
+
+@_count
+def hook_config(mask, callback, data):
+    return _hook('config', mask=mask, callback=callback, data=data)
+
+@_count
+def hook_modifier(modifier, callback, data):
+    return _hook('modifier', modifier=modifier.split('|')[-1], callback=callback, data=data)
+
+@_count
+def hook_command(command, description, args, args_description, completion, callback, data):
+    return _hook('command', command=command, callback=callback, data=data)
+
+@_count
+def hook_command_run(command, callback, data):
+    return _hook('command_run', command=command, callback=callback, data=data)
+
+@_count
+def hook_completion(name, description, callback, data):
+    return _hook('completion', name=name, callback=callback, data=data)
+
+@_count
+def hook_completion_list_add(completion, word, nick_completion, where):
+    pass
+
+@_count
+def hook_info(name, description, arguments, callback, data):
+    return _hook('info', name=name, callback=callback, data=data)
+
+@_count
+def hook_timer(interval, align_second, max_calls, callback, data):
+    return _hook('timer', interval=interval, max_calls=max_calls, callback=callback, data=data,
+                 due=clock() + interval / 1000.0)
+
+def _unhook(hook):
+    for i, other in enumerate(hooks):
+        if other is hook:
+            del hooks[i]
+            break
+
+@_count
+def unhook(hook):
+    _unhook(hook)
+
+def send_signal(signal, signal_data):
+    ''' Run the signal hooks matching a signal. '''
+    for hook in list(hooks):
+        if hook['type'] == 'signal' and _match(hook['signal'], signal):
+            _call(hook, hook['data'], signal, signal_data)
+
+# Seconds the clock was skipped forward by run_timers
+_skipped = 0.0
+
+def clock():
+    ''' A monotonic clock that runs with time.perf_counter, skipped forward
+    when run_timers waits for a timer. Scripts can use it as their
+    perf_counter so their timers see the time pass. '''
+    return time.perf_counter() + _skipped
+
+def run_timers(limit=10000):
+    ''' Run the timers that fire once, including the ones they create, in
+    the order they are due, skipping the clock forward to them. Timers that
+    repeat are left alone. Returns the number of timer calls. '''
+    global _skipped
+    count = 0
+    while count < limit:
+        timers = [hook for hook in hooks if hook['type'] == 'timer' and hook['max_calls'] == 1]
+        if not timers:
+            break
+        hook = min(timers, key=lambda hook: hook['due'])
+        _skipped += max(0.0, hook['due'] - clock())
+        _unhook(hook)
+        _call(hook, hook['data'], 0)
+        count += 1
+    return count
@@ -21,6 +21,33 @@
 #
 #
 # History:
+# 2026-10-18: acidvegas
+#   version 42: match nicks the way the IRC server compares them, with the
+#               CASEMAPPING it announces, remember which nick every word of
+#               a buffer names
+#   version 41: only keep the nick tables of the most recently active
+#               buffers, new options max_buffers and max_nicks
+#   version 40: replace match_limit with a time budget per line, count lines
+#               and their latency by matching path, add /colorize_nicks stats
+#               and info colorize_nicks_stats
+#   version 39: colorize the input bar incrementally, only tokenizing again
+#               the words around the edit
+#   version 38: apply nicklist changes in batches, so mass joins and netsplits
+#               update the nick tables once
+#   version 37: remember recently colorized lines in a bounded LRU cache,
+#               add /colorize_nicks cache
+#   version 36: compute nick colors in the script with WeeChat's nick color
+#               hash, checked against WeeChat after every color change
+#   version 35: share one nick color table between all buffers, forget the
+#               nicks of closed buffers, add /colorize_nicks memory
+#   version 34: populate the nicks of a buffer the first time a line is
+#               printed in it, recolor nicks in chunks after color changes
+#   version 33: compile the options into a snapshot rebuilt on config changes,
+#               cache the channel name and blacklist status of buffers
+#   version 32: colorize a line in a single pass over collected nick spans,
+#               cache the compiled lazy matching regexps
+#   version 31: match nicks with a per-buffer Aho-Corasick automaton instead
+#               of comparing every word against every nick in greedy mode
 # 2022-11-07: mva
 #   version 30: add ":" and "," to VALID_NICK regexp,
 #               to don't reset colorization in input_line
@@ -91,12 +118,18 @@
 # such as ~ (which some irc networks do happen to accept)
 
 import weechat
+import itertools
+import json
 import re
+import string
+import sys
+import time
+from collections import namedtuple, OrderedDict
 w = weechat
 
 SCRIPT_NAME    = "colorize_nicks"
 SCRIPT_AUTHOR  = "xt <xt@bash.no>"
-SCRIPT_VERSION = "30"
+SCRIPT_VERSION = "42"
 SCRIPT_LICENSE = "GPL"
 SCRIPT_DESC    = "Use the weechat nick colors in the chat area"
 
@@ -104,11 +137,101 @@ SCRIPT_DESC    = "Use the weechat nick colors in the chat area"
 # of anything but " ,*?.!@".
 VALID_NICK = r'([@~&!%+-])?([^\s,\*?\.!@:,]+)'
 valid_nick_re = re.compile(VALID_NICK)
-ignore_channels = []
-ignore_nicks = []
+url_re = re.compile(r'(?<!\S)https?://\S*')
 
-# Dict with every nick on every channel with its color as lookup value
-colored_nicks = {}
+# Translation tables folding nicks into their canonical form for the
+# CASEMAPPING values of IRC servers. Folding keeps the length of the text, so
+# spans found in a folded line are the spans of the nicks in the line.
+CASEMAPS = {
+    'ascii': str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    'rfc1459': str.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+    'strict-rfc1459': str.maketrans(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+}
+
+# Snapshot of the options, rebuilt whenever one of them changes
+Settings = namedtuple('Settings', [
+    'blacklist_channels', 'blacklist_nicks', 'min_nick_length',
+    'colorize_input', 'ignore_tags', 'greedy_matching', 'time_budget',
+    'ignore_nicks_in_urls', 'local_nick_colors', 'color_self_check',
+    'line_cache_size', 'max_buffers', 'max_nicks', 'reset', 'self_color'])
+settings = None
+
+# Snapshot of the WeeChat options used to hash nicks into colors
+NickColorConfig = namedtuple('NickColorConfig', [
+    'hash', 'salt', 'stop_chars', 'colors', 'forced'])
+nick_color_config = None
+
+# Color codes by color name
+color_codes = {}
+
+# Number of computed nick colors still to compare with WeeChat, and whether
+# the computed colors can be used at all
+color_self_checks = 0
+local_colors_valid = True
+
+# Channel name, IRC server, canonical own nick, blacklist status and
+# casemapping translation table (None to compare nicks exactly) of every
+# buffer seen by the callbacks
+BufferInfo = namedtuple('BufferInfo', ['channel', 'server', 'nick', 'blacklisted', 'casemap'])
+buffer_infos = {}
+
+# Dict with the nicks of every populated channel by their canonical form,
+# least recently active first. Past max_buffers or max_nicks, the least
+# recently active channels are forgotten, and populated again on their next
+# line.
+colored_nicks = OrderedDict()
+evicted_buffers = 0
+
+# Color of every nick of colored_nicks, shared by all channels, and the
+# number of channels every nick is in
+nick_colors = {}
+nick_refs = {}
+
+# Dict with a NickMatcher for the nicks of every channel
+nick_matchers = {}
+
+# Version of the nick set of every channel, changed whenever the nicks, own
+# nick or channel of the buffer change
+nick_set_versions = {}
+version_counter = itertools.count()
+
+# Colorized lines by (buffer, nick set version, line), least recently used
+# first, with hit and miss counters
+line_cache = OrderedDict()
+line_cache_hits = 0
+line_cache_misses = 0
+
+# Nicklist changes by buffer, nick -> added or removed, applied together by a
+# timer or before the buffer's next line
+NICK_FLUSH_INTERVAL = 20
+nick_deltas = {}
+nick_flush_timer = None
+
+# Nicks waiting for a new color, recolored in chunks by a timer
+RECOLOR_CHUNK = 500
+RECOLOR_INTERVAL = 10
+recolor_pending = {}
+recolor_timer = None
+
+# Last input of every buffer as (nick set version, input, spans, colorized
+# input)
+input_cache = {}
+
+# Canonical nick named by every word seen in the lines of a buffer, or None
+# if the word names no nick, as (nick set version, {word: nick})
+TOKEN_MEMO_MAX = 4096
+token_memos = {}
+
+# Compiled lazy matching regexps by canonical nick
+LAZY_PATTERNS_MAX = 4096
+lazy_patterns = {}
+
+# Lines seen by colorize_cb and the time spent on them, by matching path.
+# Bucket i of the latency histogram counts the lines that took less than
+# 2^i microseconds, the last one the lines that took longer.
+STATS_PATHS = ('greedy', 'lazy', 'fallback', 'skipped', 'cached')
+STATS_BUCKETS = 18
+path_stats = {}
 
 CONFIG_FILE_NAME = "colorize_nicks"
 
@@ -157,31 +280,412 @@ def colorize_config_init():
         colorize_config_file, section_look, "greedy_matching",
         "boolean", "If off, then use lazy matching instead", "", 0,
         0, "on", "on", 0, "", "", "", "", "", "")
-    colorize_config_option["match_limit"] = weechat.config_new_option(
-        colorize_config_file, section_look, "match_limit",
-        "integer", "Fall back to lazy matching if greedy matches exceeds this number", "",
-        20, 1000, "", "", 0, "", "", "", "", "", "")
+    colorize_config_option["time_budget"] = weechat.config_new_option(
+        colorize_config_file, section_look, "time_budget",
+        "integer", "Time in microseconds greedy matching may spend on a line before falling back to lazy matching (0 = no limit)", "",
+        0, 1000000, "2000", "2000", 0, "", "", "", "", "", "")
     colorize_config_option["ignore_nicks_in_urls"] = weechat.config_new_option(
         colorize_config_file, section_look, "ignore_nicks_in_urls",
         "boolean", "If on, don't colorize nicks inside URLs", "", 0,
         0, "off", "off", 0, "", "", "", "", "", "")
+    colorize_config_option["local_nick_colors"] = weechat.config_new_option(
+        colorize_config_file, section_look, "local_nick_colors",
+        "boolean", "If on, compute nick colors in the script with the same hash as WeeChat instead of asking WeeChat for every nick", "", 0,
+        0, "on", "on", 0, "", "", "", "", "", "")
+    colorize_config_option["color_self_check"] = weechat.config_new_option(
+        colorize_config_file, section_look, "color_self_check",
+        "integer", "Number of nick colors computed by the script to compare with WeeChat after a color option changes; on a difference, colors are asked from WeeChat again (0 = no check)", "",
+        0, 1000, "20", "20", 0, "", "", "", "", "", "")
+    colorize_config_option["line_cache_size"] = weechat.config_new_option(
+        colorize_config_file, section_look, "line_cache_size",
+        "integer", "Number of colorized lines to remember, so repeated lines are not matched again (0 = no cache)", "",
+        0, 100000, "256", "256", 0, "", "", "", "", "", "")
+    colorize_config_option["max_buffers"] = weechat.config_new_option(
+        colorize_config_file, section_look, "max_buffers",
+        "integer", "Number of most recently active buffers to keep the nicks of; the nicks of other buffers are read again from the nicklist on their next line (0 = no limit)", "",
+        0, 100000, "0", "0", 0, "", "", "", "", "", "")
+    colorize_config_option["max_nicks"] = weechat.config_new_option(
+        colorize_config_file, section_look, "max_nicks",
+        "integer", "Number of nicks, summed over buffers, to keep before forgetting the nicks of the least recently active buffers (0 = no limit)", "",
+        0, 10000000, "0", "0", 0, "", "", "", "", "", "")
 
 def colorize_config_read():
     ''' Read configuration file. '''
     global colorize_config_file
     return weechat.config_read(colorize_config_file)
 
-def colorize_nick_color(nick, my_nick):
-    ''' Retrieve nick color from weechat. '''
-    if nick == my_nick:
-        return w.color(w.config_string(w.config_get('weechat.color.chat_nick_self')))
+def update_settings(*args):
+    ''' Compile the options into the settings snapshot. '''
+    global settings
+    old_settings = settings
+    option = colorize_config_option
+    settings = Settings(
+        blacklist_channels=frozenset(w.config_string(option['blacklist_channels']).split(',')),
+        blacklist_nicks=frozenset(w.config_string(option['blacklist_nicks']).split(',')),
+        min_nick_length=w.config_integer(option['min_nick_length']),
+        colorize_input=w.config_boolean(option['colorize_input']),
+        ignore_tags=frozenset(w.config_string(option['ignore_tags']).split(',')),
+        greedy_matching=w.config_boolean(option['greedy_matching']),
+        time_budget=w.config_integer(option['time_budget']) / 1e6,
+        ignore_nicks_in_urls=w.config_boolean(option['ignore_nicks_in_urls']),
+        local_nick_colors=w.config_boolean(option['local_nick_colors']),
+        color_self_check=w.config_integer(option['color_self_check']),
+        line_cache_size=w.config_integer(option['line_cache_size']),
+        max_buffers=w.config_integer(option['max_buffers']),
+        max_nicks=w.config_integer(option['max_nicks']),
+        reset=w.color('reset'),
+        self_color=w.color(w.config_string(w.config_get('weechat.color.chat_nick_self'))))
+    buffer_infos.clear()
+    token_memos.clear()
+    line_cache.clear()
+    input_cache.clear()
+
+    if old_settings is not None and (
+            settings.local_nick_colors != old_settings.local_nick_colors or
+            settings.color_self_check != old_settings.color_self_check):
+        invalidate_colors()
+
+    evict_buffers()
+
+    return w.WEECHAT_RC_OK
+
+def update_nick_color_config():
+    ''' Compile the WeeChat options used to hash nicks into a snapshot. '''
+    global nick_color_config
+
+    def option(name):
+        return w.config_string(w.config_get(name))
+
+    forced = {}
+    for item in option('weechat.look.nick_color_force').split(';'):
+        nick, separator, color = item.partition(':')
+        if separator:
+            forced[nick] = color
+
+    nick_color_config = NickColorConfig(
+        hash=option('weechat.look.nick_color_hash'),
+        salt=option('weechat.look.nick_color_hash_salt'),
+        stop_chars=option('weechat.look.nick_color_stop_chars'),
+        colors=[color.strip() for color in option('weechat.color.chat_nick_colors').split(',')
+                if color.strip()],
+        forced=forced)
+
+def server_casemap(server):
+    ''' Retrieve the casemapping translation table of an IRC server. '''
+    casemapping = w.info_get('irc_server_isupport_value', '%s,CASEMAPPING' % server)
+    # Servers not announcing a casemapping use the one of RFC 1459
+    return CASEMAPS.get(casemapping.lower() or 'rfc1459', CASEMAPS['ascii'])
+
+def buffer_info(buffer):
+    ''' Retrieve the cached channel name, server, own nick, blacklist status
+    and casemapping of a buffer. '''
+    info = buffer_infos.get(buffer)
+    if info is None:
+        channel = w.buffer_get_string(buffer, 'localvar_channel')
+        server = w.buffer_get_string(buffer, 'localvar_server')
+        casemap = None
+        if server and w.buffer_get_string(buffer, 'plugin') == 'irc':
+            casemap = server_casemap(server)
+        nick = w.buffer_get_string(buffer, 'localvar_nick')
+        info = buffer_infos[buffer] = BufferInfo(
+            channel, server, nick.translate(casemap) if casemap else nick,
+            bool(channel) and channel in settings.blacklist_channels, casemap)
+    return info
+
+def buffer_changed_cb(data, signal, buffer):
+    ''' Forget the cached information of a renamed buffer. '''
+    buffer_infos.pop(buffer, None)
+    if buffer in nick_set_versions:
+        nick_set_versions[buffer] = next(version_counter)
+    return w.WEECHAT_RC_OK
+
+def isupport_cb(data, signal, signal_data):
+    ''' Forget the nicks of the buffers of a server when its casemapping
+    changes, they are indexed by their canonical form. '''
+    server = signal.split(',', 1)[0]
+    casemap = server_casemap(server)
+    for buffer in list(colored_nicks):
+        # Buffers without cached information may have been indexed with the
+        # old casemapping too
+        info = buffer_infos.get(buffer)
+        if info is None or (info.server == server and info.casemap is not None and
+                            info.casemap is not casemap):
+            buffer_infos.pop(buffer, None)
+            forget_buffer(buffer)
+    return w.WEECHAT_RC_OK
+
+def hash_nick_color_name(nick):
+    ''' Find the name of the color of a nick the way WeeChat does: strip the
+    nick at the first stop char, look for a forced color, then hash the salted
+    nick with djb2 or a sum of its code points, on 64 or 32 bits. '''
+    config = nick_color_config
+
+    other_char = False
+    for i, char in enumerate(nick):
+        if char not in config.stop_chars:
+            other_char = True
+        elif other_char:
+            nick = nick[:i]
+            break
+
+    forced = config.forced.get(nick) or config.forced.get(nick.lower())
+    if forced:
+        return forced
+    if not config.colors:
+        return 'default'
+
+    mask = 0xffffffff if config.hash.endswith('_32') else 0xffffffffffffffff
+    if config.hash.startswith('sum'):
+        color = sum(ord(char) for char in config.salt + nick) & mask
     else:
-        return w.info_get('nick_color', nick)
+        color = 5381
+        for char in config.salt + nick:
+            color = (color ^ ((color << 5) + (color >> 2) + ord(char))) & mask
+    return config.colors[color % len(config.colors)]
+
+def color_code(name):
+    ''' Retrieve the color code of a color name. '''
+    code = color_codes.get(name)
+    if code is None:
+        code = color_codes[name] = sys.intern(w.color(name))
+    return code
+
+def colorize_nick_color(nick):
+    ''' Retrieve nick color, computed by the script if possible. The first
+    computed colors after a color option change are compared with WeeChat. '''
+    global color_self_checks, local_colors_valid
+
+    if not settings.local_nick_colors or not local_colors_valid:
+        return sys.intern(w.info_get('nick_color', nick))
+
+    color = color_code(hash_nick_color_name(nick))
+    if color_self_checks > 0:
+        color_self_checks -= 1
+        expected = w.info_get('nick_color', nick)
+        if color != expected:
+            local_colors_valid = False
+            w.prnt('', '%s: computed color of nick "%s" differs from WeeChat, '
+                   'asking WeeChat for nick colors' % (SCRIPT_NAME, nick))
+            return sys.intern(expected)
+    return color
+
+def nick_color(buffer, nick):
+    ''' Retrieve the color of a nick in a buffer, given in its canonical form.
+    Own nick has its own color. '''
+    if nick == buffer_info(buffer).nick:
+        return settings.self_color
+    nick = colored_nicks[buffer][nick]
+    if nick in recolor_pending:
+        del recolor_pending[nick]
+        nick_colors[nick] = colorize_nick_color(nick)
+    return nick_colors[nick]
+
+class NickMatcherNode(object):
+    ''' A state of the NickMatcher automaton. '''
+
+    __slots__ = ('parent', 'char', 'depth', 'children', 'nick', 'fail',
+                 'output', 'version')
+
+    def __init__(self, parent, char):
+        self.parent = parent
+        self.char = char
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.children = {}
+        self.nick = None
+        self.fail = None
+        self.output = None
+        self.version = -1
+
+class NickMatcher(object):
+    ''' Aho-Corasick automaton over the nicks of one buffer.
+
+    The trie is updated in place when nicks are added or removed. Failure and
+    output links are only computed for the states a scan actually visits, and
+    are invalidated by bumping the version whenever the nick set changes. '''
+
+    def __init__(self, nicks=()):
+        self.root = NickMatcherNode(None, '')
+        self.root.fail = self.root
+        self.version = 0
+        for nick in nicks:
+            self.add(nick)
+
+    def add(self, nick):
+        ''' Add a nick to the automaton. '''
+        node = self.root
+        for char in nick:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = NickMatcherNode(node, char)
+            node = child
+        node.nick = nick
+        self.version += 1
+
+    def remove(self, nick):
+        ''' Remove a nick from the automaton, pruning branches left unused. '''
+        node = self.root
+        for char in nick:
+            node = node.children.get(char)
+            if node is None:
+                return
+        if node.nick is None:
+            return
+        node.nick = None
+        while node is not self.root and node.nick is None and not node.children:
+            del node.parent.children[node.char]
+            node = node.parent
+        self.version += 1
+
+    def _link(self, node):
+        ''' Make sure the failure and output links of node are up to date. '''
+        if node.version == self.version or node is self.root:
+            return
+        if node.parent is self.root:
+            fail = self.root
+        else:
+            self._link(node.parent)
+            fail = self._goto(node.parent.fail, node.char)
+        node.fail = fail
+        if fail is self.root:
+            node.output = None
+        else:
+            self._link(fail)
+            node.output = fail if fail.nick is not None else fail.output
+        node.version = self.version
+
+    def _goto(self, node, char):
+        ''' Follow the transition for char from node. '''
+        while True:
+            child = node.children.get(char)
+            if child is not None:
+                return child
+            if node is self.root:
+                return node
+            self._link(node)
+            node = node.fail
+
+    def findall(self, text, deadline=0):
+        ''' Return the leftmost longest non-overlapping nicks in text as a
+        list of (start, end, nick) tuples, or None if the scan is still
+        running at deadline (a time.perf_counter() value, 0 for none). '''
+        found = []
+        node = self.root
+        for end, char in enumerate(text, 1):
+            if deadline and not end & 0xff and time.perf_counter() > deadline:
+                return None
+            node = self._goto(node, char)
+            if node is self.root:
+                continue
+            self._link(node)
+            match = node if node.nick is not None else node.output
+            while match is not None:
+                found.append((end - match.depth, end, match.nick))
+                match = match.output
+
+        if len(found) > 1:
+            found.sort(key=lambda match: (match[0], -match[1]))
+        matches = []
+        last_end = 0
+        for match in found:
+            if match[0] >= last_end:
+                matches.append(match)
+                last_end = match[1]
+        return matches
+
+def greedy_spans(buffer, line, nicks, deadline):
+    ''' Return the (start, end, nick) spans of the given nicks wherever they
+    occur in a word, unless a longer nick of the buffer covers them. Returns
+    None if the line is still not matched at deadline. '''
+    matches = nick_matchers[buffer].findall(line, deadline)
+    if matches is None or (deadline and time.perf_counter() > deadline):
+        return None
+
+    urls = []
+    if settings.ignore_nicks_in_urls:
+        urls = [match.span() for match in url_re.finditer(line)]
+
+    spans = []
+    for span in matches:
+        if span[2] not in nicks:
+            continue
+        if urls and any(start <= span[0] < end for start, end in urls):
+            continue
+        spans.append(span)
+
+    return spans
+
+def lazy_pattern(nick):
+    ''' Return the compiled lazy matching regexp for nick. '''
+    pattern = lazy_patterns.get(nick)
+    if pattern is None:
+        if len(lazy_patterns) >= LAZY_PATTERNS_MAX:
+            lazy_patterns.clear()
+        # The two .? are in case somebody writes "nick:", "nick,", etc
+        # to address somebody
+        pattern = lazy_patterns[nick] = re.compile(
+            r"(?<!\S).?(%s).?(?!\S)" % re.escape(nick))
+    return pattern
+
+def lazy_spans(line, nicks):
+    ''' Return the (start, end, nick) spans of the first whitespace separated
+    occurrence of a nick for every time it was named in the line. '''
+    spans = []
+    for nick, count in nicks.items():
+        for match in lazy_pattern(nick).finditer(line):
+            spans.append(match.span(1) + (nick,))
+            count -= 1
+            if not count:
+                break
+    return spans
+
+def colorize_spans(line, spans, colors, reset):
+    ''' Build the colorized line from (start, end, nick) spans in one pass.
+    Spans overlapping an earlier one are dropped. '''
+    parts = []
+    last_end = 0
+    for start, end, nick in sorted(spans):
+        if start < last_end:
+            continue
+        parts.append(line[last_end:start])
+        parts.append(colors[nick])
+        parts.append(line[start:end])
+        parts.append(reset)
+        last_end = end
+    parts.append(line[last_end:])
+    return ''.join(parts)
+
+class PathStats(object):
+    ''' Number of lines, time spent and latency histogram of a matching
+    path. '''
+
+    __slots__ = ('count', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * STATS_BUCKETS
+
+def reset_stats():
+    ''' Forget the statistics of all matching paths. '''
+    for path in STATS_PATHS:
+        path_stats[path] = PathStats()
+
+def record_stats(path, start):
+    ''' Count a line that took path and started at start. '''
+    elapsed = time.perf_counter() - start
+    stats = path_stats[path]
+    stats.count += 1
+    stats.total += elapsed
+    if elapsed > stats.max:
+        stats.max = elapsed
+    stats.histogram[min(int(elapsed * 1e6).bit_length(), STATS_BUCKETS - 1)] += 1
 
 def colorize_cb(data, modifier, modifier_data, line):
     ''' Callback that does the colorizing, and returns new line if changed '''
+    global line_cache_hits, line_cache_misses
 
-    global ignore_nicks, ignore_channels, colored_nicks
+    start = time.perf_counter()
 
     if modifier_data.startswith('0x'):
         # WeeChat >= 2.9
@@ -191,206 +695,482 @@ def colorize_cb(data, modifier, modifier_data, line):
         plugin, buffer_name, tags = modifier_data.split(';', 2)
         buffer = w.buffer_search(plugin, buffer_name)
 
-    channel = w.buffer_get_string(buffer, 'localvar_channel')
-    tags = tags.split(',')
+    if buffer_info(buffer).blacklisted:
+        record_stats('skipped', start)
+        return line
 
-    # Check if buffer has colorized nicks
-    if buffer not in colored_nicks:
+    # Don't colorize if the ignored tag is present in message
+    if not settings.ignore_tags.isdisjoint(tags.split(',')):
+        record_stats('skipped', start)
         return line
 
-    if channel and channel in ignore_channels:
+    # Check if buffer has colorized nicks
+    known = buffer_nicks(buffer)
+    if not known:
+        record_stats('skipped', start)
         return line
 
-    min_length = w.config_integer(colorize_config_option['min_nick_length'])
-    reset = w.color('reset')
+    if not settings.line_cache_size:
+        new_line, path = colorize_line(buffer, known, line, start)
+        record_stats(path, start)
+        return new_line
 
-    # Don't colorize if the ignored tag is present in message
-    tag_ignores = w.config_string(colorize_config_option['ignore_tags']).split(',')
-    for tag in tags:
-        if tag in tag_ignores:
-            return line
+    key = (buffer, nick_set_versions[buffer], line)
+    new_line = line_cache.get(key)
+    if new_line is not None:
+        line_cache_hits += 1
+        line_cache.move_to_end(key)
+        record_stats('cached', start)
+        return new_line
+
+    line_cache_misses += 1
+    new_line, path = colorize_line(buffer, known, line, start)
+    line_cache[key] = new_line
+    while len(line_cache) > settings.line_cache_size:
+        line_cache.popitem(last=False)
+    record_stats(path, start)
+    return new_line
+
+def resolve_word(word, known, casemap):
+    ''' Return the canonical form of the known nick a word names, or None. '''
+    nick = word.translate(casemap) if casemap else word
+
+    # If the matched word is not a known nick, we try to match the
+    # word without its first or last character (if not a letter).
+    # This is necessary as "foo:" is a valid nick, which could be
+    # adressed as "foo::".
+    if nick not in known:
+        if not word[-1].isalpha() and not word[0].isalpha():
+            nick = nick[1:-1]
+        elif not word[0].isalpha():
+            nick = nick[1:]
+        elif not word[-1].isalpha():
+            nick = nick[:-1]
+        if nick not in known:
+            return None
 
+    # Check that nick is not ignored and longer than minimum length
+    if len(nick) < settings.min_nick_length or known[nick] in settings.blacklist_nicks:
+        return None
+    return nick
+
+def colorize_line(buffer, known, line, start):
+    ''' Colorize the known nicks of a buffer in a line, started at start.
+    Returns the new line and the matching path it took. '''
+    casemap = buffer_info(buffer).casemap
+
+    # Words already resolved in the buffer take a single lookup
+    version = nick_set_versions[buffer]
+    memo = token_memos.get(buffer)
+    if memo is None or memo[0] != version or len(memo[1]) > TOKEN_MEMO_MAX:
+        memo = token_memos[buffer] = (version, {})
+    resolved = memo[1]
+
+    nicks = {}
     for words in valid_nick_re.findall(line):
-        nick = words[1]
-
-        # If the matched word is not a known nick, we try to match the
-        # word without its first or last character (if not a letter).
-        # This is necessary as "foo:" is a valid nick, which could be
-        # adressed as "foo::".
-        if nick not in colored_nicks[buffer]:
-            if not nick[-1].isalpha() and not nick[0].isalpha():
-                if nick[1:-1] in colored_nicks[buffer]:
-                    nick = nick[1:-1]
-            elif not nick[0].isalpha():
-                if nick[1:] in colored_nicks[buffer]:
-                    nick = nick[1:]
-            elif not nick[-1].isalpha():
-                if nick[:-1] in colored_nicks[buffer]:
-                    nick = nick[:-1]
+        word = words[1]
+        nick = resolved.get(word, '')
+        if nick == '':
+            nick = resolved[word] = resolve_word(word, known, casemap)
+        if nick is not None:
+            nicks[nick] = nicks.get(nick, 0) + 1
 
-        # Check that nick is not ignored and longer than minimum length
-        if len(nick) < min_length or nick in ignore_nicks:
-            continue
+    if not nicks:
+        return line, 'skipped'
 
-        # Check that nick is in the dictionary colored_nicks
-        if nick in colored_nicks[buffer]:
-            nick_color = colored_nicks[buffer][nick]
-
-            try:
-                # Let's use greedy matching. Will check against every word in a line.
-                if w.config_boolean(colorize_config_option['greedy_matching']):
-                    cnt = 0
-                    limit = w.config_integer(colorize_config_option['match_limit'])
-
-                    for word in line.split():
-                        cnt += 1
-                        assert cnt < limit
-                        #  if cnt > limit:
-                            #  raise RuntimeError('Exceeded colorize_nicks.look.match_limit.');
-
-                        if w.config_boolean(colorize_config_option['ignore_nicks_in_urls']) and \
-                              word.startswith(('http://', 'https://')):
-                            continue
-
-                        if nick in word:
-                            # Is there a nick that contains nick and has a greater lenght?
-                            # If so let's save that nick into var biggest_nick
-                            biggest_nick = ""
-                            for i in colored_nicks[buffer]:
-                                cnt += 1
-                                assert cnt < limit
-
-                                if nick in i and nick != i and len(i) > len(nick):
-                                    if i in word:
-                                        # If a nick with greater len is found, and that word
-                                        # also happens to be in word, then let's save this nick
-                                        biggest_nick = i
-                            # If there's a nick with greater len, then let's skip this
-                            # As we will have the chance to colorize when biggest_nick
-                            # iterates being nick.
-                            if len(biggest_nick) > 0 and biggest_nick in word:
-                                pass
-                            elif len(word) < len(biggest_nick) or len(biggest_nick) == 0:
-                                new_word = word.replace(nick, '%s%s%s' % (nick_color, nick, reset))
-                                line = line.replace(word, new_word)
-
-                # Switch to lazy matching
-                else:
-                    raise AssertionError
+    # Nicks are matched in the canonical form of the line
+    canonical_line = line.translate(casemap) if casemap else line
 
-            except AssertionError:
-                # Let's use lazy matching for nick
-                nick_color = colored_nicks[buffer][nick]
-                # The two .? are in case somebody writes "nick:", "nick,", etc
-                # to address somebody
-                regex = r"(\A|\s).?(%s).?(\Z|\s)" % re.escape(nick)
-                match = re.search(regex, line)
-                if match is not None:
-                    new_line = line[:match.start(2)] + nick_color+nick+reset + line[match.end(2):]
-                    line = new_line
+    # Let's use greedy matching. Will check against every word in a line,
+    # unless it takes longer than the time budget.
+    path = 'lazy'
+    spans = None
+    if settings.greedy_matching:
+        deadline = start + settings.time_budget if settings.time_budget else 0
+        spans = greedy_spans(buffer, canonical_line, nicks, deadline)
+        path = 'greedy' if spans is not None else 'fallback'
 
-    return line
+    # Switch to lazy matching
+    if spans is None:
+        spans = lazy_spans(canonical_line, nicks)
 
-def colorize_input_cb(data, modifier, modifier_data, line):
-    ''' Callback that does the colorizing in input '''
+    if not spans:
+        return line, path
 
-    global ignore_nicks, ignore_channels, colored_nicks
+    colors = dict((nick, nick_color(buffer, nick)) for nick in nicks)
+    return colorize_spans(line, spans, colors, settings.reset), path
 
-    min_length = w.config_integer(colorize_config_option['min_nick_length'])
+def input_spans(line, start, end, known):
+    ''' Return the (start, end, nick) spans of the known nicks between start
+    and end in the canonical form of the input. '''
+    min_length = settings.min_nick_length
+    spans = []
+    for match in valid_nick_re.finditer(line, start, end):
+        nick = match.group(2)
+        if nick not in known:
+            continue
+        # Check that nick is not ignored and longer than minimum length
+        if len(nick) < min_length or known[nick] in settings.blacklist_nicks:
+            continue
+        spans.append(match.span(2) + (nick,))
+    return spans
+
+def colorize_input_cb(data, modifier, modifier_data, line):
+    ''' Callback that does the colorizing in input '''
 
-    if not w.config_boolean(colorize_config_option['colorize_input']):
+    if not settings.colorize_input:
         return line
 
     buffer = w.current_buffer()
-    # Check if buffer has colorized nicks
-    if buffer not in colored_nicks:
+    info = buffer_info(buffer)
+    if info.blacklisted:
         return line
 
-    channel = w.buffer_get_string(buffer, 'name')
-    if channel and channel in ignore_channels:
+    # Check if buffer has colorized nicks
+    known = buffer_nicks(buffer)
+    if not known:
         return line
 
-    reset = w.color('reset')
+    # Nicks are matched in the canonical form of the input
+    canonical_line = line.translate(info.casemap) if info.casemap else line
 
-    for words in valid_nick_re.findall(line):
-        nick = words[1]
-        # Check that nick is not ignored and longer than minimum length
-        if len(nick) < min_length or nick in ignore_nicks:
+    version = nick_set_versions[buffer]
+    cached = input_cache.get(buffer)
+    if cached is None or cached[0] != version:
+        spans = input_spans(canonical_line, 0, len(line), known)
+    elif cached[1] == line:
+        return cached[3]
+    else:
+        # Only tokenize again the words around the edit, the spans before it
+        # are kept and the spans after it are shifted
+        old_line, old_spans = cached[1], cached[2]
+        shift = len(line) - len(old_line)
+
+        prefix = 0
+        limit = min(len(line), len(old_line))
+        while prefix < limit and line[prefix] == old_line[prefix]:
+            prefix += 1
+        suffix = 0
+        limit -= prefix
+        while suffix < limit and line[-1 - suffix] == old_line[-1 - suffix]:
+            suffix += 1
+
+        start = prefix
+        while start > 0 and not line[start - 1].isspace():
+            start -= 1
+        end = len(line) - suffix
+        while end < len(line) and not line[end].isspace():
+            end += 1
+
+        spans = [span for span in old_spans if span[1] <= start]
+        spans.extend(input_spans(canonical_line, start, end, known))
+        spans.extend((span[0] + shift, span[1] + shift, span[2])
+                     for span in old_spans if span[0] >= end - shift)
+
+    if spans:
+        colors = dict((span[2], nick_color(buffer, span[2])) for span in spans)
+        new_line = colorize_spans(line, spans, colors, settings.reset)
+    else:
+        new_line = line
+    input_cache[buffer] = (version, line, spans, new_line)
+    return new_line
+
+def ref_nick(nick):
+    ''' Count a channel in for a nick, retrieving its color for the first one.
+    Returns the interned nick. '''
+    nick = sys.intern(nick)
+    if nick in nick_refs:
+        nick_refs[nick] += 1
+    else:
+        nick_refs[nick] = 1
+        nick_colors[nick] = colorize_nick_color(nick)
+    return nick
+
+def unref_nick(nick, canonical):
+    ''' Count a channel out for a nick, forgetting it after the last one.
+    Lazy patterns are compiled for the canonical form of the nick. '''
+    nick_refs[nick] -= 1
+    if not nick_refs[nick]:
+        del nick_refs[nick]
+        del nick_colors[nick]
+        recolor_pending.pop(nick, None)
+        lazy_patterns.pop(canonical, None)
+
+def populate_buffer(buffer):
+    ''' Fill the nicks of a buffer from its nicklist. '''
+    global colored_nicks, nick_matchers
+
+    casemap = buffer_info(buffer).casemap
+    nicks = colored_nicks[buffer] = {}
+    matcher = nick_matchers[buffer] = NickMatcher()
+    nick_set_versions[buffer] = next(version_counter)
+    nick_deltas.pop(buffer, None)
+
+    nicklist = w.infolist_get('nicklist', buffer, '')
+    while w.infolist_next(nicklist):
+        if w.infolist_string(nicklist, 'type') != 'nick':
             continue
-        if nick in colored_nicks[buffer]:
-            nick_color = colored_nicks[buffer][nick]
-            line = line.replace(nick, '%s%s%s' % (nick_color, nick, reset))
 
-    return line
+        nick = w.infolist_string(nicklist, 'name')
+        canonical = sys.intern(nick.translate(casemap)) if casemap else nick
+        if canonical not in nicks:
+            nicks[canonical] = ref_nick(nick)
+            matcher.add(canonical)
 
-def populate_nicks(*args):
-    ''' Fills entire dict with all nicks weechat can see and what color it has
-    assigned to it. '''
-    global colored_nicks
+    w.infolist_free(nicklist)
 
-    colored_nicks = {}
+    evict_buffers()
 
-    buffers = w.infolist_get('buffer', '', '')
-    while w.infolist_next(buffers):
-        buffer_ptr = w.infolist_pointer(buffers, 'pointer')
-        my_nick = w.buffer_get_string(buffer_ptr, 'localvar_nick')
-        nicklist = w.infolist_get('nicklist', buffer_ptr, '')
-        while w.infolist_next(nicklist):
-            if buffer_ptr not in colored_nicks:
-                colored_nicks[buffer_ptr] = {}
+    return nicks
 
-            if w.infolist_string(nicklist, 'type') != 'nick':
-                continue
+def evict_buffers():
+    ''' Forget the nicks of the least recently active buffers past
+    max_buffers or max_nicks, keeping at least the most recent one. '''
+    global evicted_buffers
 
-            nick = w.infolist_string(nicklist, 'name')
-            nick_color = colorize_nick_color(nick, my_nick)
+    if settings.max_buffers:
+        while len(colored_nicks) > settings.max_buffers:
+            forget_buffer(next(iter(colored_nicks)))
+            evicted_buffers += 1
 
-            colored_nicks[buffer_ptr][nick] = nick_color
+    if settings.max_nicks:
+        entries = sum(len(nicks) for nicks in colored_nicks.values())
+        while len(colored_nicks) > 1 and entries > settings.max_nicks:
+            buffer = next(iter(colored_nicks))
+            entries -= len(colored_nicks[buffer])
+            forget_buffer(buffer)
+            evicted_buffers += 1
 
-        w.infolist_free(nicklist)
+def buffer_nicks(buffer):
+    ''' Retrieve the nicks of a buffer and mark it as the most
+    recently active, populating it the first time the buffer is seen (or
+    after it was forgotten) and applying its queued nicklist changes. '''
+    nicks = colored_nicks.get(buffer)
+    if nicks is None:
+        # Buffers without nicks (core, server, query) take no slot
+        if not w.buffer_get_integer(buffer, 'nicklist_nicks_count'):
+            return {}
+        nicks = populate_buffer(buffer)
+    else:
+        colored_nicks.move_to_end(buffer)
+        if buffer in nick_deltas:
+            flush_nicks(buffer)
+    return nicks
+
+def forget_buffer(buffer):
+    ''' Drop the nicks of a buffer. '''
+    nicks = colored_nicks.pop(buffer, None)
+    nick_matchers.pop(buffer, None)
+    nick_set_versions.pop(buffer, None)
+    nick_deltas.pop(buffer, None)
+    token_memos.pop(buffer, None)
+    input_cache.pop(buffer, None)
+    if nicks:
+        for canonical, nick in nicks.items():
+            unref_nick(nick, canonical)
+
+def invalidate_colors(*args):
+    ''' Queue every known nick for a new color. '''
+    global recolor_timer, color_self_checks, local_colors_valid
+
+    update_nick_color_config()
+    color_codes.clear()
+    line_cache.clear()
+    input_cache.clear()
+    color_self_checks = settings.color_self_check
+    local_colors_valid = True
+
+    recolor_pending.update(dict.fromkeys(nick_colors))
 
-    w.infolist_free(buffers)
+    if recolor_pending and not recolor_timer:
+        recolor_timer = w.hook_timer(RECOLOR_INTERVAL, 0, 1, 'recolor_timer_cb', '')
 
     return w.WEECHAT_RC_OK
 
-def add_nick(data, signal, type_data):
-    ''' Add nick to dict of colored nicks '''
-    global colored_nicks
+def recolor_timer_cb(data, remaining_calls):
+    ''' Recolor queued nicks in chunks of RECOLOR_CHUNK per timer call. '''
+    global recolor_timer
+
+    for i in range(min(RECOLOR_CHUNK, len(recolor_pending))):
+        nick = recolor_pending.popitem()[0]
+        nick_colors[nick] = colorize_nick_color(nick)
+
+    recolor_timer = None
+    if recolor_pending:
+        recolor_timer = w.hook_timer(RECOLOR_INTERVAL, 0, 1, 'recolor_timer_cb', '')
+
+    return w.WEECHAT_RC_OK
+
+def queue_nick(type_data, added):
+    ''' Queue a nicklist change for the next flush. '''
+    global nick_flush_timer
 
     # Nicks can have , in them in some protocols
-    splitted = type_data.split(',')
-    pointer = splitted[0]
-    nick = ",".join(splitted[1:])
+    pointer, nick = type_data.split(',', 1)
+
+    # Buffers are populated from their nicklist the first time they are seen
     if pointer not in colored_nicks:
-        colored_nicks[pointer] = {}
+        return
 
-    my_nick = w.buffer_get_string(pointer, 'localvar_nick')
-    nick_color = colorize_nick_color(nick, my_nick)
+    deltas = nick_deltas.get(pointer)
+    if deltas is None:
+        deltas = nick_deltas[pointer] = {}
+    deltas[nick] = added
+
+    if not nick_flush_timer:
+        nick_flush_timer = w.hook_timer(NICK_FLUSH_INTERVAL, 0, 1, 'nick_flush_timer_cb', '')
+
+def flush_nicks(buffer):
+    ''' Apply the queued nicklist changes of a buffer. '''
+    deltas = nick_deltas.pop(buffer)
+    casemap = buffer_info(buffer).casemap
+    nicks = colored_nicks[buffer]
+    matcher = nick_matchers[buffer]
+
+    changed = False
+    for nick, added in deltas.items():
+        canonical = sys.intern(nick.translate(casemap)) if casemap else nick
+        old_nick = nicks.get(canonical)
+        if added:
+            # A nick changing case replaces the old one
+            if old_nick != nick:
+                if old_nick is None:
+                    matcher.add(canonical)
+                else:
+                    unref_nick(old_nick, canonical)
+                nicks[canonical] = ref_nick(nick)
+                changed = True
+        elif old_nick == nick:
+            del nicks[canonical]
+            matcher.remove(canonical)
+            unref_nick(nick, canonical)
+            changed = True
 
-    colored_nicks[pointer][nick] = nick_color
+    if changed:
+        nick_set_versions[buffer] = next(version_counter)
+        evict_buffers()
+
+def nick_flush_timer_cb(data, remaining_calls):
+    ''' Apply the queued nicklist changes of all buffers. '''
+    global nick_flush_timer
+
+    nick_flush_timer = None
+    while nick_deltas:
+        flush_nicks(next(iter(nick_deltas)))
 
     return w.WEECHAT_RC_OK
 
+def add_nick(data, signal, type_data):
+    ''' Add nick to dict of colored nicks '''
+    queue_nick(type_data, True)
+    return w.WEECHAT_RC_OK
+
 def remove_nick(data, signal, type_data):
     ''' Remove nick from dict with colored nicks '''
-    global colored_nicks
+    queue_nick(type_data, False)
+    return w.WEECHAT_RC_OK
 
-    # Nicks can have , in them in some protocols
-    splitted = type_data.split(',')
-    pointer = splitted[0]
-    nick = ",".join(splitted[1:])
+def buffer_closing_cb(data, signal, buffer):
+    ''' Drop the nicks and cached information of a closing buffer. '''
+    buffer_infos.pop(buffer, None)
+    forget_buffer(buffer)
+    return w.WEECHAT_RC_OK
 
-    if pointer in colored_nicks and nick in colored_nicks[pointer]:
-        del colored_nicks[pointer][nick]
+def sizeof(obj, seen):
+    ''' Return the size of obj and of the containers, strings and matcher
+    states it holds, counting every object once. '''
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (set, frozenset, list, tuple)):
+        for item in obj:
+            size += sizeof(item, seen)
+    elif isinstance(obj, NickMatcher):
+        size += sizeof(obj.root, seen)
+    elif isinstance(obj, NickMatcherNode):
+        size += sizeof(obj.children, seen) + sizeof(obj.nick, seen)
+    return size
 
-    return w.WEECHAT_RC_OK
+def colorize_memory():
+    ''' Print how much memory the nick tables use. '''
+    seen = set()
+    colors_size = sizeof(nick_colors, seen) + sizeof(nick_refs, seen)
+    sets_size = sizeof(colored_nicks, seen)
+    matchers_size = sizeof(nick_matchers, seen)
+    entries = sum(len(nicks) for nicks in colored_nicks.values())
 
-def update_blacklist(*args):
-    ''' Set the blacklist for channels and nicks. '''
-    global ignore_channels, ignore_nicks
-    ignore_channels = w.config_string(colorize_config_option['blacklist_channels']).split(',')
-    ignore_nicks = w.config_string(colorize_config_option['blacklist_nicks']).split(',')
-    return w.WEECHAT_RC_OK
+    w.prnt('', '%s: %d buffers, %d nick entries, %d unique nicks' % (
+        SCRIPT_NAME, len(colored_nicks), entries, len(nick_colors)))
+    w.prnt('', '  buffers forgotten for inactivity: %d (max_buffers: %d, max_nicks: %d)' % (
+        evicted_buffers, settings.max_buffers, settings.max_nicks))
+    w.prnt('', '  nick colors: %.1f KiB' % (colors_size / 1024.0))
+    w.prnt('', '  buffer nick sets: %.1f KiB' % (sets_size / 1024.0))
+    w.prnt('', '  nick matchers: %.1f KiB' % (matchers_size / 1024.0))
+    w.prnt('', '  total: %.1f KiB' % ((colors_size + sets_size + matchers_size) / 1024.0))
+
+def colorize_cache():
+    ''' Print the size and hit rate of the line cache. '''
+    lookups = line_cache_hits + line_cache_misses
+    w.prnt('', '%s: line cache: %d/%d lines, %d hits, %d misses (%.1f%% hits)' % (
+        SCRIPT_NAME, len(line_cache), settings.line_cache_size, line_cache_hits,
+        line_cache_misses, 100.0 * line_cache_hits / lookups if lookups else 0.0))
+
+def stats_percentile(stats, fraction):
+    ''' Return the upper bound in microseconds of the histogram bucket
+    holding the given fraction of the lines of a path. '''
+    rank = fraction * stats.count
+    seen = 0
+    for bucket, count in enumerate(stats.histogram):
+        seen += count
+        if count and seen >= rank:
+            return 1 << bucket
+    return 1 << (STATS_BUCKETS - 1)
+
+def colorize_stats():
+    ''' Print the number of lines and the latency of every matching path. '''
+    w.prnt('', '%s: lines by matching path, latency in microseconds (time budget: %d)' % (
+        SCRIPT_NAME, settings.time_budget * 1e6))
+    for path in STATS_PATHS:
+        stats = path_stats[path]
+        if not stats.count:
+            w.prnt('', '  %s: 0 lines' % path)
+            continue
+        w.prnt('', '  %s: %d lines, avg %.1f, max %.1f, p50 < %d, p99 < %d' % (
+            path, stats.count, stats.total * 1e6 / stats.count, stats.max * 1e6,
+            stats_percentile(stats, 0.50), stats_percentile(stats, 0.99)))
+        w.prnt('', '    %s' % ' '.join(
+            '%s%d:%d' % ('<' if bucket < STATS_BUCKETS - 1 else '>=',
+                         1 << bucket if bucket < STATS_BUCKETS - 1 else 1 << (bucket - 1), count)
+            for bucket, count in enumerate(stats.histogram) if count))
+
+def stats_info_cb(data, info_name, arguments):
+    ''' Return the statistics of the matching paths, or of the path given as
+    argument, as JSON. '''
+    paths = [arguments] if arguments in path_stats else STATS_PATHS
+    return json.dumps(dict((path, {
+        'count': path_stats[path].count,
+        'total_us': round(path_stats[path].total * 1e6, 1),
+        'max_us': round(path_stats[path].max * 1e6, 1),
+        'histogram': path_stats[path].histogram,
+    }) for path in paths), sort_keys=True)
+
+def colorize_cmd_cb(data, buffer, args):
+    ''' Callback for the /colorize_nicks command. '''
+    args = args.strip()
+    if args == 'memory':
+        colorize_memory()
+        return w.WEECHAT_RC_OK
+    if args == 'cache':
+        colorize_cache()
+        return w.WEECHAT_RC_OK
+    if args == 'stats':
+        colorize_stats()
+        return w.WEECHAT_RC_OK
+    return w.WEECHAT_RC_ERROR
 
 if __name__ == "__main__":
     if w.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE,
@@ -399,18 +1179,37 @@ if __name__ == "__main__":
         colorize_config_read()
 
         # Run once to get data ready
-        update_blacklist()
-        populate_nicks()
+        update_settings()
+        invalidate_colors()
+        reset_stats()
 
         w.hook_signal('nicklist_nick_added', 'add_nick', '')
         w.hook_signal('nicklist_nick_removed', 'remove_nick', '')
         w.hook_modifier('weechat_print', 'colorize_cb', '')
         # Hook config for changing colors
-        w.hook_config('weechat.color.chat_nick_colors', 'populate_nicks', '')
-        w.hook_config('weechat.look.nick_color_hash', 'populate_nicks', '')
+        w.hook_config('weechat.color.chat_nick_colors', 'invalidate_colors', '')
+        w.hook_config('weechat.look.nick_color_*', 'invalidate_colors', '')
         # Hook for working togheter with other scripts (like colorize_lines)
         w.hook_modifier('colorize_nicks', 'colorize_cb', '')
         # Hook for modifying input
         w.hook_modifier('250|input_text_display', 'colorize_input_cb', '')
-        # Hook for updating blacklist (this could be improved to use fnmatch)
-        weechat.hook_config('%s.look.blacklist*' % SCRIPT_NAME, 'update_blacklist', '')
+        # Hook for updating the settings snapshot
+        weechat.hook_config('%s.look.*' % SCRIPT_NAME, 'update_settings', '')
+        # Hooks for forgetting the cached information of a buffer
+        for signal in ('buffer_renamed', 'buffer_localvar_added',
+                       'buffer_localvar_changed', 'buffer_localvar_removed'):
+            w.hook_signal(signal, 'buffer_changed_cb', '')
+        w.hook_signal('buffer_closing', 'buffer_closing_cb', '')
+        # Hook for the casemapping of IRC servers
+        w.hook_signal('*,irc_in2_005', 'isupport_cb', '')
+        w.hook_config('weechat.color.chat_nick_self', 'update_settings', '')
+        w.hook_command(SCRIPT_NAME, SCRIPT_DESC, 'memory || cache || stats',
+                       'memory: show how much memory the nick tables use\n'
+                       ' cache: show the size and hit rate of the line cache\n'
+                       ' stats: show the number of lines and their latency by matching path',
+                       'memory || cache || stats', 'colorize_cmd_cb', '')
+        w.hook_info('%s_stats' % SCRIPT_NAME,
+                    'lines colorized and their latency by matching path, as JSON; '
+                    'bucket i of a histogram counts lines that took less than 2^i microseconds',
+                    'matching path (greedy, lazy, fallback, skipped, cached), all paths if empty',
+                    'stats_info_cb', '')
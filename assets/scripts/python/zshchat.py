@@ -2,17 +2,122 @@
 # ZSH-style ghost hint autosuggestions for commands - developed by acidvegas in python (https://github.com/acidvegas/weechat)
 
 import weechat
+import bisect
 import re
+from collections import OrderedDict
 
 SCRIPT_NAME    = 'autosuggest'
 SCRIPT_AUTHOR  = 'acidvegas'
-SCRIPT_VERSION = '1.2'
+SCRIPT_VERSION = '1.5'
 SCRIPT_LICENSE = 'ISC'
 SCRIPT_DESC    = 'ZSH-style ghost hint autosuggestions for commands'
 
+
+class HistoryNode:
+    '''A node of the history prefix tree, for the lowercased commands starting with its label.'''
+    
+    __slots__ = ('label', 'children', 'count', 'ends', 'newest')
+    
+    def __init__(self, label):
+        self.label    = label # Part of the key between the parent and this node
+        self.children = {}    # First character of the label -> child node
+        self.count    = 0     # Commands below this node, including the ones ending here
+        self.ends     = 0     # Commands ending here (commands differing only by case)
+        self.newest   = None  # Most recent command below this node
+
+
+class CommandHistory:
+    '''Commands in order of last use, with a prefix tree of their lowercased text.'''
+    
+    def __init__(self):
+        self.clear()
+    
+    def __len__(self):
+        return len(self.commands)
+    
+    def clear(self):
+        self.commands = OrderedDict() # Command -> use counter, oldest first
+        self.root     = HistoryNode('')
+        self.counter  = 0
+    
+    def add(self, cmd, limit):
+        '''Add a command, or make it the most recent, and forget the oldest ones over limit (no limit if 0).'''
+        self.counter += 1
+        known = cmd in self.commands
+        self.commands[cmd] = self.counter
+        self.commands.move_to_end(cmd)
+        for node in self.path(cmd.lower(), not known):
+            node.newest = cmd
+        while 0 < limit < len(self.commands):
+            self.remove(self.commands.popitem(last=False)[0])
+    
+    def path(self, key, insert):
+        '''Get the nodes from the root to the one of key, counting a new command along it if insert.'''
+        node  = self.root
+        nodes = [node]
+        i     = 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None:
+                child = node.children[key[i]] = HistoryNode(key[i:])
+            elif not key.startswith(child.label, i):
+                # Split the edge where the key leaves it
+                common = 1
+                while key[i + common:i + common + 1] == child.label[common:common + 1]:
+                    common += 1
+                middle = node.children[key[i]] = HistoryNode(child.label[:common])
+                middle.count  = child.count
+                middle.newest = child.newest
+                child.label   = child.label[common:]
+                middle.children[child.label[0]] = child
+                child = middle
+            i += len(child.label)
+            node = child
+            nodes.append(node)
+        if insert:
+            for node in nodes:
+                node.count += 1
+            node.ends += 1
+        return nodes
+    
+    def remove(self, cmd):
+        '''Remove the oldest command from the prefix tree.'''
+        nodes = self.path(cmd.lower(), False)
+        nodes[-1].ends -= 1
+        for node in nodes:
+            node.count -= 1
+        # Being the oldest, the command is only the newest of nodes it is alone in
+        for parent, node in reversed(list(zip(nodes, nodes[1:]))):
+            if not node.count:
+                del parent.children[node.label[0]]
+            elif not node.ends and len(node.children) == 1:
+                # Merge the node with its only child
+                child = next(iter(node.children.values()))
+                child.label = node.label + child.label
+                parent.children[child.label[0]] = child
+    
+    def find(self, prefix):
+        '''Get the most recent command starting with prefix (lowercased) and longer than it.'''
+        node = self.root
+        i    = 0
+        while i < len(prefix):
+            child = node.children.get(prefix[i])
+            if child is None:
+                return ''
+            if not prefix.startswith(child.label, i):
+                # Everything below the child is longer than the prefix, if it goes on along the edge
+                if child.label.startswith(prefix[i:]):
+                    return child.newest
+                return ''
+            i += len(child.label)
+            node = child
+        newest = [child.newest for child in node.children.values()]
+        return max(newest, key=self.commands.__getitem__) if newest else ''
+
+
 # Global state
 current_suggestion = ''
-command_history    = []
+command_history    = CommandHistory()
 channel_history    = set()
 hooks              = []
 
@@ -39,26 +144,20 @@ def config_init():
 
 def add_to_history(cmd):
     '''Add command to history (no duplicates).'''
-    global command_history, channel_history
+    global channel_history
     
     if not cmd or not cmd.startswith('/'):
         return
     
-    # Remove if exists (will re-add at end)
-    if cmd in command_history:
-        command_history.remove(cmd)
-    
-    command_history.append(cmd)
+    max_hist = int(config_get('max_history') or '5000')
+    command_history.add(cmd, max_hist)
     
     # Extract channels
     channels = re.findall(r'(#[^\s,]+)', cmd)
     for chan in channels:
-        channel_history.add(chan)
-    
-    # Trim if needed
-    max_hist = int(config_get('max_history') or '5000')
-    if len(command_history) > max_hist:
-        command_history = command_history[-max_hist:]
+        if chan not in channel_history:
+            channel_history.add(chan)
+            name_caches['channels'].add(chan)
 
 
 def get_aliases():
@@ -137,38 +236,141 @@ def get_all_channels():
     return channels
 
 
+class NameCache:
+    '''Names sorted by their lowercased text, read again from loader after an invalidate().'''
+    
+    def __init__(self, loader):
+        self.loader = loader
+        self.keys   = None
+    
+    def __len__(self):
+        self.load()
+        return len(self.keys)
+    
+    def __contains__(self, name):
+        self.load()
+        return name.lower() in self.lookup
+    
+    def invalidate(self):
+        self.keys = None
+    
+    def load(self):
+        if self.keys is None:
+            entries     = sorted(set((name.lower(), name) for name in self.loader()))
+            self.keys   = [key for key, name in entries]
+            self.names  = [name for key, name in entries]
+            self.lookup = set(self.keys)
+    
+    def add(self, name):
+        '''Add a name without reading them all again, if they are loaded.'''
+        if self.keys is not None and name.lower() not in self.lookup:
+            i = bisect.bisect(self.keys, name.lower())
+            self.keys.insert(i, name.lower())
+            self.names.insert(i, name)
+            self.lookup.add(name.lower())
+    
+    def remove(self, name):
+        '''Remove a name without reading them all again, if they are loaded.'''
+        if self.keys is not None and name.lower() in self.lookup:
+            key = name.lower()
+            i   = bisect.bisect_left(self.keys, key)
+            while i < len(self.keys) and self.keys[i] == key:
+                if self.names[i] == name:
+                    del self.keys[i], self.names[i]
+                    break
+                i += 1
+            if key not in self.keys[max(i - 1, 0):i + 1]:
+                self.lookup.discard(key)
+    
+    def first(self):
+        self.load()
+        return self.names[0] if self.names else ''
+    
+    def complete(self, partial):
+        '''Get the first name starting with partial (lowercased) and longer than it.'''
+        self.load()
+        # Names equal to partial sort right before the ones it is a prefix of
+        i = bisect.bisect_right(self.keys, partial)
+        if i < len(self.keys) and self.keys[i].startswith(partial):
+            return self.names[i]
+        return ''
+
+
+# Names read from infolists, refreshed by the hooks in cache_hooks
+name_caches = {
+    'aliases'  : NameCache(get_aliases),
+    'commands' : NameCache(get_weechat_commands),
+    'servers'  : NameCache(get_servers),
+    'channels' : NameCache(get_all_channels),
+}
+
+# Nicks of the channel buffers suggested from so far, by buffer pointer
+nick_caches = {}
+
+# Hooks (type, signal or config option) and the caches they invalidate
+cache_hooks = [
+    ('config', 'alias.cmd.*',        'aliases,commands'),
+    ('signal', 'plugin_loaded',      'commands'),
+    ('signal', 'plugin_unloaded',    'commands'),
+    ('signal', '*_script_loaded',    'commands'),
+    ('signal', '*_script_unloaded',  'commands'),
+    ('config', 'irc.server.*',       'servers'),
+    ('signal', 'irc_channel_opened', 'channels'),
+    ('signal', 'irc_pv_opened',      'channels'),
+    ('signal', 'buffer_closed',      'channels'),
+]
+
+
+def cache_invalidate_cb(data, signal, signal_data):
+    '''Called on the signals and options of cache_hooks, data names the caches to invalidate.'''
+    for name in data.split(','):
+        name_caches[name].invalidate()
+    return weechat.WEECHAT_RC_OK
+
+
+def get_nick_cache(buffer):
+    '''Get the nicks of a buffer, read from its nicklist on first use.'''
+    if buffer not in nick_caches:
+        nick_caches[buffer] = NameCache(lambda: get_buffer_nicks(buffer))
+    return nick_caches[buffer]
+
+
+def nicklist_changed_cb(data, signal, signal_data):
+    '''Called when a nick is added or removed and when a buffer is closed, to update the nick caches.'''
+    if signal == 'buffer_closed':
+        nick_caches.pop(signal_data, None)
+        return weechat.WEECHAT_RC_OK
+    
+    buffer, _, nick = signal_data.partition(',')
+    cache = nick_caches.get(buffer)
+    if cache is not None:
+        if signal == 'nicklist_nick_added':
+            cache.add(nick)
+        else:
+            cache.remove(nick)
+    return weechat.WEECHAT_RC_OK
+
+
 def suggest_nick(buffer, partial):
     '''Suggest a nick based on partial input.'''
     buffer_type = weechat.buffer_get_string(buffer, 'localvar_type')
     if buffer_type != 'channel':
         return ''
     
-    nicks = get_buffer_nicks(buffer)
-    partial_lower = partial.lower()
-    for nick in sorted(nicks, key=str.lower):
-        if nick.lower().startswith(partial_lower) and nick.lower() != partial_lower:
-            return nick[len(partial):]
-    return ''
+    nick = get_nick_cache(buffer).complete(partial.lower())
+    return nick[len(partial):]
 
 
 def suggest_channel(partial):
     '''Suggest a channel based on partial input.'''
-    all_channels = get_all_channels()
-    partial_lower = partial.lower()
-    for chan in sorted(all_channels, key=str.lower):
-        if chan.lower().startswith(partial_lower) and chan.lower() != partial_lower:
-            return chan[len(partial):]
-    return ''
+    chan = name_caches['channels'].complete(partial.lower())
+    return chan[len(partial):]
 
 
 def suggest_server(partial):
     '''Suggest a server based on partial input.'''
-    servers = get_servers()
-    partial_lower = partial.lower()
-    for server in sorted(servers, key=str.lower):
-        if server.lower().startswith(partial_lower) and server.lower() != partial_lower:
-            return server[len(partial):]
-    return ''
+    server = name_caches['servers'].complete(partial.lower())
+    return server[len(partial):]
 
 
 def find_suggestion(input_text, buffer):
@@ -177,10 +379,9 @@ def find_suggestion(input_text, buffer):
         return ''
     
     # Check history first (most recent match)
-    input_lower = input_text.lower()
-    for cmd in reversed(command_history):
-        if cmd.lower().startswith(input_lower) and cmd.lower() != input_lower:
-            return cmd[len(input_text):]
+    cmd = command_history.find(input_text.lower())
+    if cmd:
+        return cmd[len(input_text):]
     
     # Split into command and args
     parts = input_text.split(' ', 1)
@@ -193,16 +394,14 @@ def find_suggestion(input_text, buffer):
         cmd_lower = cmd_part.lower()
         
         # Check aliases first
-        aliases = get_aliases()
-        for alias in sorted(aliases.keys()):
-            if alias.lower().startswith(cmd_lower) and alias.lower() != cmd_lower:
-                return alias[len(cmd_part):]
+        alias = name_caches['aliases'].complete(cmd_lower)
+        if alias:
+            return alias[len(cmd_part):]
         
         # Check weechat commands
-        commands = get_weechat_commands()
-        for cmd in sorted(commands.keys()):
-            if cmd.lower().startswith(cmd_lower) and cmd.lower() != cmd_lower:
-                return cmd[len(cmd_part):]
+        cmd = name_caches['commands'].complete(cmd_lower)
+        if cmd:
+            return cmd[len(cmd_part):]
     
     # If we have a command and are typing args
     elif has_args or input_text.endswith(' '):
@@ -229,8 +428,7 @@ def find_suggestion(input_text, buffer):
         server_commands = ['/connect', '/disconnect', '/reconnect', '/server']
         
         # Check if this is an alias - if so, treat args as potentially nick/channel
-        aliases = get_aliases()
-        is_alias = cmd_part in aliases or cmd_part.lower() in [a.lower() for a in aliases]
+        is_alias = cmd_part in name_caches['aliases']
         
         # Suggest channel if typing #
         if last_word.startswith('#'):
@@ -246,17 +444,13 @@ def find_suggestion(input_text, buffer):
         
         # For channel commands with no arg yet, suggest first channel
         elif cmd_lower in channel_commands and not last_word:
-            all_channels = get_all_channels()
-            if all_channels:
-                return sorted(all_channels)[0]
+            return name_caches['channels'].first()
         
         # For aliases with no arg yet, try nick suggestion
         elif is_alias and not last_word:
             buffer_type = weechat.buffer_get_string(buffer, 'localvar_type')
             if buffer_type == 'channel':
-                nicks = get_buffer_nicks(buffer)
-                if nicks:
-                    return sorted(nicks, key=str.lower)[0]
+                return get_nick_cache(buffer).first()
         
         # Suggest server
         elif cmd_lower in server_commands:
@@ -265,9 +459,7 @@ def find_suggestion(input_text, buffer):
                 if suggestion:
                     return suggestion
             else:
-                servers = get_servers()
-                if servers:
-                    return servers[0]
+                return name_caches['servers'].first()
     
     return ''
 
@@ -354,7 +546,7 @@ def command_run_input_cb(data, buffer, command):
 
 def command_autosuggest_cb(data, buffer, args):
     '''Handle /autosuggest command.'''
-    global command_history, channel_history
+    global channel_history
     
     args_list = args.split()
     
@@ -365,15 +557,16 @@ def command_autosuggest_cb(data, buffer, args):
         weechat.prnt('', '  accept_key: %s' % config_get('accept_key'))
         weechat.prnt('', '  max_history: %s' % config_get('max_history'))
         weechat.prnt('', '  history entries: %d' % len(command_history))
-        weechat.prnt('', '  channels known: %d' % len(get_all_channels()))
-        weechat.prnt('', '  aliases: %d' % len(get_aliases()))
-        weechat.prnt('', '  commands: %d' % len(get_weechat_commands()))
-        weechat.prnt('', '  servers: %d' % len(get_servers()))
+        weechat.prnt('', '  channels known: %d' % len(name_caches['channels']))
+        weechat.prnt('', '  aliases: %d' % len(name_caches['aliases']))
+        weechat.prnt('', '  commands: %d' % len(name_caches['commands']))
+        weechat.prnt('', '  servers: %d' % len(name_caches['servers']))
         return weechat.WEECHAT_RC_OK
     
     elif args_list[0] == 'clear':
-        command_history = []
+        command_history.clear()
         channel_history = set()
+        name_caches['channels'].invalidate()
         weechat.prnt('', 'autosuggest: history cleared')
         return weechat.WEECHAT_RC_OK
     
@@ -401,6 +594,15 @@ if __name__ == '__main__':
         hooks.append(weechat.hook_command_run('/input *',
                                                'command_run_input_cb', ''))
         
+        for hook_type, name, caches in cache_hooks:
+            if hook_type == 'config':
+                hooks.append(weechat.hook_config(name, 'cache_invalidate_cb', caches))
+            else:
+                hooks.append(weechat.hook_signal(name, 'cache_invalidate_cb', caches))
+        
+        for signal in ('nicklist_nick_added', 'nicklist_nick_removed', 'buffer_closed'):
+            hooks.append(weechat.hook_signal(signal, 'nicklist_changed_cb', ''))
+        
         weechat.hook_command(
             'autosuggest',
             'Autosuggest management',